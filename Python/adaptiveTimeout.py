@@ -0,0 +1,67 @@
+import threading
+from logStats import bucketFor, quantile
+
+# Latency estimate for one node/operation: an EWMA plus a log-bucketed histogram for the tail.
+# The histogram is halved every decayEvery samples so it follows the node's current behaviour.
+# Timed out operations only go into the EWMA: the histogram holds real answers
+class LatencyTracker:
+    def __init__(self, alpha=0.05, decayEvery=1000):
+        self.alpha = alpha
+        self.decayEvery = decayEvery
+        self.ewma = None
+        self.hist = {}
+        self.count = 0
+        self.samples = 0
+
+    def record(self, seconds, timedOut=False):
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.samples += 1
+        if timedOut: return
+        b = bucketFor(seconds * 1000000)
+        self.hist[b] = self.hist.get(b, 0) + 1
+        self.count += 1
+        if self.count >= self.decayEvery:
+            self.hist = {b: n // 2 for b, n in self.hist.items() if n > 1}
+            self.count = sum(self.hist.values())
+
+    # Seconds
+    def quantile(self, q):
+        return quantile(self.hist, self.count, q, float('inf')) / 1000000 if self.count else 0
+
+# Works out a timeout for each node/operation from the latencies actually seen:
+# multiplier x max(p99, ewma), kept between floor and ceiling (seconds).
+# Until minSamples have been seen for a node/operation the ceiling (the normal timeout) is used.
+# A timeout counts as taking the tail of the real answers (or the floor, if the node hasn't answered yet),
+# not the whole timeout: otherwise a run of them drags the timeout back up to the ceiling during the very
+# outage it's meant to cut short
+class AdaptiveTimeouts:
+    def __init__(self, floor=0.02, ceiling=2.5, multiplier=3, quantile=0.99, minSamples=50):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.multiplier = multiplier
+        self.q = quantile
+        self.minSamples = minSamples
+        self.trackers = {}
+        self.lock = threading.Lock()
+
+    def record(self, node, op, seconds, timedOut=False):
+        with self.lock:
+            tracker = self.trackers.get((node, op))
+            if tracker is None:
+                tracker = self.trackers[(node, op)] = LatencyTracker()
+            if timedOut: seconds = min(seconds, tracker.quantile(self.q) if tracker.count else self.floor)
+            tracker.record(seconds, timedOut)
+
+    def timeoutFor(self, node, op):
+        with self.lock:
+            tracker = self.trackers.get((node, op))
+            if tracker is None or tracker.samples < self.minSamples:
+                return self.ceiling
+            tail = max(tracker.quantile(self.q), tracker.ewma)
+        return min(self.ceiling, max(self.floor, tail * self.multiplier))
+
+    def getStats(self):
+        with self.lock:
+            trackers = dict(self.trackers)
+        return {node + ' ' + op: {'samples': t.samples, 'ewma': t.ewma, 'p99': t.quantile(self.q), 'timeout': self.timeoutFor(node, op)}
+                for (node, op), t in trackers.items()}
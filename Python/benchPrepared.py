@@ -0,0 +1,46 @@
+from couchbase.cluster import Cluster
+from couchbase.cluster import PasswordAuthenticator
+from couchbase.n1ql    import N1QLQuery
+from prepared import PreparedStatements
+import time, sys
+
+# Compares ad-hoc and prepared latency for the airport search in N1QLFetchAirports
+# Usage: python3 benchPrepared.py [runs]
+
+CONN_STR = 'couchbase://10.143.191.101,10.143.191.102,10.143.191.103'
+cluster = Cluster(CONN_STR)
+authenticator = PasswordAuthenticator('Danzibob', 'C0uchbase123')
+cluster.authenticate(authenticator)
+bucket = cluster.open_bucket('travel-sample')
+print("Connected.")
+
+QUERY = "SELECT airportname, city FROM `travel-sample` WHERE LOWER(airportname) LIKE $1"
+SEARCHES = ["man", "ard", "int", "a", "heathrow"]
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples)-1, int(len(samples) * p / 100))]
+
+def timeRuns(run, runs):
+    times = []
+    for i in range(runs):
+        param = "%" + SEARCHES[i % len(SEARCHES)] + "%"
+        start = time.perf_counter()
+        for row in run(param): pass
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+prepared = PreparedStatements(bucket)
+adhoc = lambda param: bucket.n1ql_query(N1QLQuery(QUERY, param))
+execute = lambda param: prepared.query(QUERY, param)
+
+# Warm both paths up (and prepare the statement) before timing
+timeRuns(adhoc, len(SEARCHES))
+timeRuns(execute, len(SEARCHES))
+
+for name, run in [("ad-hoc", adhoc), ("prepared", execute)]:
+    times = timeRuns(run, runs)
+    print("{0:10} runs={1} p50={2:.2f}ms p99={3:.2f}ms mean={4:.2f}ms".format(
+        name, runs, percentile(times, 50), percentile(times, 99), sum(times) / len(times)))
+print(prepared.getStats())
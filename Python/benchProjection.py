@@ -0,0 +1,44 @@
+import fakeBucket, json, random, tracemalloc, sys
+from fakeBucket import FakeBucket, FakeResult
+from projection import project
+
+# Memory per row of an airport search result in each representation, no cluster needed.
+# Documents come from the stand-in bucket and go through json (as the SDK would decode them),
+# so every row has its own strings, as it would coming off the wire.
+# Usage: python3 benchProjection.py [rows]
+
+FIELDS = ('airportname', 'city')
+
+bucket = FakeBucket()
+bucket.loadSampleData()
+docs = [json.dumps(v) for k, (v, cas) in bucket.docs.items() if v['type'] == 'airport']
+
+def documents(n):
+    return [json.loads(docs[i % len(docs)]) for i in range(n)]
+
+def rowDicts(n):
+    return [{f: d[f] for f in FIELDS} for d in documents(n)]
+
+def results(n):
+    return {'airport_' + str(i): FakeResult('airport_' + str(i), d, i) for i, d in enumerate(documents(n))}
+
+# Bytes still allocated per row after build(n) (what the result set itself holds)
+def bytesPerRow(build, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    res = build(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / n
+
+REPRESENTATIONS = [
+    ('get_multi results (full docs)', results),
+    ('N1QL row dicts',                rowDicts),
+    ('slotted records',               lambda n: project(rowDicts(n), FIELDS)),
+    ('columns',                       lambda n: project(rowDicts(n), FIELDS, columnar=True)),
+]
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+random.seed(1)
+for name, build in REPRESENTATIONS:
+    print("{0:32} {1:8.0f} bytes/row".format(name, bytesPerRow(build, n)))
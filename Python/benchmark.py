@@ -0,0 +1,114 @@
+import random, time, sys
+import fakeBucket
+from fakeBucket import FakeBucket, FakeNode
+from adaptiveTimeout import AdaptiveTimeouts
+
+# Runs the resilience helpers in clean.py against an in-process bucket (fakeBucket.py) under
+# different fault scenarios, and reports throughput and latency for each. No cluster needed.
+# Usage: python3 benchmark.py [ops per run] [scenario ...]
+#
+# KV timeouts and retry delays are scaled down by TIME_SCALE (2.5s -> 50ms, 1s -> 20ms) so
+# a run takes seconds rather than hours. Node latencies are not scaled.
+
+TIME_SCALE = 0.02
+KV_TIMEOUT = 2.5 * TIME_SCALE
+RETRY_DELAY_MS = 1000 * TIME_SCALE
+
+def nodes(**sick):
+    return [FakeNode('10.0.0.1', medianMs=0.3), FakeNode('10.0.0.2', medianMs=0.3),
+            FakeNode('10.0.0.3', **dict({'medianMs': 0.3}, **sick))]
+
+# Faults are all on the third node unless said otherwise
+SCENARIOS = {
+    'healthy':       lambda: dict(nodes=nodes()),
+    'slowNode':      lambda: dict(nodes=nodes(medianMs=5, sigma=1)),
+    'timeouts':      lambda: dict(nodes=nodes(timeoutRate=0.05)),
+    'nodeDown':      lambda: dict(nodes=nodes(down=True)),
+    'networkErrors': lambda: dict(nodes=nodes(networkErrorRate=0.1)),
+    'tempFails':     lambda: dict(nodes=[FakeNode('10.0.0.' + str(i), medianMs=0.3, tempFailRate=0.02) for i in range(1, 4)]),
+    'queryErrors':   lambda: dict(nodes=nodes(), n1qlErrorRate=0.5),
+    'slowQueries':   lambda: dict(nodes=nodes(), slowQueryRate=0.2, slowQueryMs=500),
+}
+
+bucket = FakeBucket(timeout=KV_TIMEOUT)
+bucket.loadSampleData()
+fakeBucket.install(bucket)
+import clean
+import spans
+tracer = spans.Tracer(spans.InMemoryExporter(), spans.RateLimitingSampler(100))
+
+KEYS = ['airport_' + str(i) for i in range(1000)]
+SEARCHES = ['man', 'ard', 'int', 'ber', 'ville']
+
+# Runs op with adaptive timeouts turned on (shared by every adaptive strategy in a scenario)
+adaptive = None
+def withAdaptiveTimeouts(op):
+    def run():
+        clean.adaptiveTimeouts = adaptive
+        try:
+            return op()
+        finally:
+            clean.adaptiveTimeouts = None
+    return run
+
+# Runs op with tracing on (1% sampled, spans kept in memory)
+def withTracing(op):
+    def run():
+        spans.tracer = tracer
+        try:
+            return op()
+        finally:
+            spans.tracer = None
+    return run
+
+def n1qlFetch():
+    res = clean.N1QLFetchAirports(random.choice(SEARCHES))
+    for row in (res.values() if isinstance(res, dict) else res): pass
+
+# name -> (operation, share of the ops count to run)
+STRATEGIES = {
+    'getNormalOrReplica':         (lambda: clean.getNormalOrReplica(random.choice(KEYS)), 1),
+    'getNormalOrReplica(hedge)':  (lambda: clean.getNormalOrReplica(random.choice(KEYS), hedge=True), 1),
+    'getNormalOrReplica(adapt)':  (withAdaptiveTimeouts(lambda: clean.getNormalOrReplica(random.choice(KEYS))), 1),
+    'getNormalOrReplica(traced)': (withTracing(lambda: clean.getNormalOrReplica(random.choice(KEYS))), 1),
+    'getOrRetry':                 (lambda: clean.getOrRetry(random.choice(KEYS), 2, RETRY_DELAY_MS), 1),
+    'getRetryThenReplica':        (lambda: clean.getRetryThenReplica(random.choice(KEYS), 2, RETRY_DELAY_MS), 1),
+    'upsertAndCheck':             (lambda: clean.upsertAndCheck('bench_' + str(random.randrange(100)), {'n': random.random()}, 4, RETRY_DELAY_MS), 1),
+    'N1QLFetchAirports':          (n1qlFetch, 0.05),
+    'N1QLFetchAirports(hedged)':  (lambda: clean.N1QLFetchAirportsHedged(random.choice(SEARCHES), delay=0.05), 0.05),
+}
+
+def percentile(samples, p):
+    return samples[min(len(samples)-1, int(len(samples) * p / 100))] if samples else 0
+
+def run(op, ops):
+    times = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(ops):
+        t = time.perf_counter()
+        try:
+            op()
+        except Exception:
+            errors += 1
+        times.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+    times.sort()
+    return {'ops': ops, 'errors': errors, 'opsPerSec': ops / elapsed,
+            'p50': percentile(times, 50), 'p99': percentile(times, 99), 'p999': percentile(times, 99.9)}
+
+def main(ops=500, scenarios=None):
+    global adaptive
+    print("{0:14} {1:27} {2:>6} {3:>7} {4:>10} {5:>9} {6:>9} {7:>9}".format(
+        'scenario', 'strategy', 'ops', 'errors', 'ops/s', 'p50 ms', 'p99 ms', 'p99.9 ms'))
+    for scenario in scenarios or SCENARIOS:
+        bucket.configure(timeout=KV_TIMEOUT, **SCENARIOS[scenario]())
+        adaptive = AdaptiveTimeouts(floor=0.001, ceiling=KV_TIMEOUT)
+        for name, (op, share) in STRATEGIES.items():
+            clean.hedgeLatencies.clear()
+            r = run(op, max(1, int(ops * share)))
+            print("{0:14} {1:27} {2:6} {3:7} {4:10.0f} {5:9.2f} {6:9.2f} {7:9.2f}".format(
+                scenario, name, r['ops'], r['errors'], r['opsPerSec'], r['p50'], r['p99'], r['p999']))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, sys.argv[2:])
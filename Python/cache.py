@@ -0,0 +1,120 @@
+import threading, time, json, os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Read-through LRU cache for documents that rarely change (airports, airlines, ...)
+# fetch(docID) is the read to put the cache in front of (e.g. getNormalOrReplica) and returns an SDK result.
+# Entries are fresh for ttl seconds. After that the next read fetches again with refresh(docID) if given
+# (e.g. just the active copy: with a stale entry to fall back on there's no point waiting for a replica),
+# unless isDown(docID) says the key's node is down. If it's down or refresh fails with one of staleOn,
+# the stale entry is served straight away and fetched again on a background thread.
+# A result with an older CAS than the entry's (e.g. from a replica that's behind) is dropped.
+# The cache is bounded by maxBytes of (JSON encoded) document values, least recently used first out
+class DocCache:
+    def __init__(self, fetch, maxBytes=64*1024*1024, ttl=60, staleOn=(), isDown=None, revalidators=2, refresh=None):
+        self.fetch = fetch
+        self.refresh = refresh or fetch
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.staleOn = staleOn
+        self.isDown = isDown
+        # docID -> [result, size, expires]
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.revalidators = revalidators
+        self.pool = ThreadPoolExecutor(max_workers=revalidators)
+        self.revalidating = set()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'revalidations': 0, 'unchanged': 0, 'older': 0, 'evictions': 0}
+        os.register_at_fork(after_in_child=self.afterFork)
+
+    # A forked child has the entries but not the parent's revalidating threads
+    def afterFork(self):
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=self.revalidators)
+        self.revalidating = set()
+
+    def get(self, docID):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(docID)
+            if entry is not None:
+                self.entries.move_to_end(docID)
+                if entry[2] > now:
+                    self.stats['hits'] += 1
+                    return entry[0]
+            self.stats['misses'] += 1
+        if entry is not None and self.isDown is not None and self.isDown(docID):
+            return self.serveStale(docID, entry)
+        try:
+            result = self.fetch(docID) if entry is None else self.refresh(docID)
+        except self.staleOn:
+            if entry is None: raise
+            return self.serveStale(docID, entry)
+        self.put(docID, result)
+        return result
+
+    def serveStale(self, docID, entry):
+        with self.lock:
+            self.stats['stale'] += 1
+            if docID in self.revalidating: return entry[0]
+            self.revalidating.add(docID)
+        self.pool.submit(self.revalidate, docID)
+        return entry[0]
+
+    def revalidate(self, docID):
+        try:
+            self.put(docID, self.fetch(docID))
+            with self.lock:
+                self.stats['revalidations'] += 1
+        except Exception:
+            # Keep serving the stale entry, the next read will try again
+            pass
+        finally:
+            with self.lock:
+                self.revalidating.discard(docID)
+
+    def put(self, docID, result):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            if self.isOlder(docID, result): return
+            entry = self.entries.get(docID)
+            # Same CAS means the document hasn't changed: keep the entry and just extend it
+            if entry is not None and result.cas and entry[0].cas == result.cas:
+                entry[2] = expires
+                self.stats['unchanged'] += 1
+                return
+        size = len(json.dumps(result.value, separators=(',', ':')))
+        if size > self.maxBytes: return
+        with self.lock:
+            # A newer one may have been put while the lock wasn't held
+            if self.isOlder(docID, result): return
+            old = self.entries.pop(docID, None)
+            if old is not None: self.size -= old[1]
+            self.entries[docID] = [result, size, expires]
+            self.size += size
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.stats['evictions'] += 1
+
+    # With the lock held
+    def isOlder(self, docID, result):
+        entry = self.entries.get(docID)
+        if entry is None or not result.cas or result.cas >= entry[0].cas: return False
+        self.stats['older'] += 1
+        return True
+
+    def invalidate(self, docID):
+        with self.lock:
+            old = self.entries.pop(docID, None)
+            if old is not None: self.size -= old[1]
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats, entries=len(self.entries), bytes=self.size)
+        reads = stats['hits'] + stats['misses']
+        stats['hitRate'] = stats['hits'] / reads if reads else 0
+        stats['missRate'] = 1 - stats['hitRate'] if reads else 0
+        stats['staleRate'] = stats['stale'] / reads if reads else 0
+        return stats
@@ -1,8 +1,29 @@
-import couchbase, logging, json, random, time, sys
+import couchbase, logging, json, random, time, sys, os, threading, asyncio, atexit
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from couchbase.bucket import LOCKMODE_WAIT
+from acouchbase.bucket import Bucket as AsyncBucket
 from couchbase.cluster import Cluster
 from couchbase.cluster import PasswordAuthenticator
 from couchbase.n1ql    import N1QLQuery, N1QLError
 import couchbase.exceptions as CBErr
+from health import HealthMonitor, NodeUnavailableException
+from cache import DocCache
+from prepared import PreparedStatements
+from retryBudget import RetryBudget, RetryBudgetExceededException
+from adaptiveTimeout import AdaptiveTimeouts
+from singleFlight import SingleFlight, AsyncSingleFlight
+from writeBehind import WriteBehindBuffer
+from spans import traced, span
+from metrics import metrics
+from journal import Journal, Reconciler, valueHash
+from projection import project
+from connections import ConnectionManager
+from trigramIndex import TrigramIndex
+from sharedCache import SharedCache
+from errorPolicy import ErrorPolicy, Action, RETRY, REPLICA, VERIFY, describe
+from warmup import Warmup
 
 # Cluster address(es) and credentials
 CONN_STR = 'couchbase://10.143.191.101,10.143.191.102,10.143.191.103'
@@ -16,128 +37,1116 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.WARN)
 logging.getLogger().addHandler(ch)
 
-# --== Threshold logging configuration ==--
-# Number of microseconds a kv operation has to take to be considered slow,
-# thus adding it to the queue. Default is 500000 (500ms)
-bucket.tracing_threshold_kv=1
-# Process the collected spans every n ms. Default 10000 (10s)
-bucket.threshold_logging_tracer_interval=10000
-# Keep track of the slowest n items. Default is 10
-bucket.tracing_threshold_queue_size=1000
-# Keep track of up to n orphaned responses. Default is 10
-bucket.tracing_orphaned_queue_size=1000
-
 # Connect to the cluster and bucket
-cluster = Cluster(CONN_STR)
-authenticator = PasswordAuthenticator(USERNAME, PASSWORD)
-cluster.authenticate(authenticator)
-bucket = cluster.open_bucket('travel-sample')
-print("Connected.")
+def openBucket():
+    cluster = Cluster(CONN_STR)
+    authenticator = PasswordAuthenticator(USERNAME, PASSWORD)
+    cluster.authenticate(authenticator)
+    # LOCKMODE_WAIT lets the hedged reads below share the bucket between threads
+    bucket = cluster.open_bucket('travel-sample', lockmode=LOCKMODE_WAIT)
+    logging.info("Connected to " + CONN_STR)
+
+    # --== Threshold logging configuration ==--
+    # Number of microseconds a kv operation has to take to be considered slow,
+    # thus adding it to the queue. Default is 500000 (500ms)
+    bucket.tracing_threshold_kv=1
+    # Process the collected spans every n ms. Default 10000 (10s)
+    bucket.threshold_logging_tracer_interval=10000
+    # Keep track of the slowest n items. Default is 10
+    bucket.tracing_threshold_queue_size=1000
+    # Keep track of up to n orphaned responses. Default is 10
+    bucket.tracing_orphaned_queue_size=1000
+    return bucket
+
+def closeBucket(b):
+    close = getattr(b, '_close', None)
+    if close: close()
+
+# Nothing connects at import: the first operation opens a connection, and up to POOL_SIZE
+# are shared between threads (see connections.py). bucket stands in for one of them.
+# Code that needs several calls on the same connection takes one with connections.get()
+POOL_SIZE = 4
+connections = ConnectionManager(openBucket, POOL_SIZE, disconnect=closeBucket, brokenOn=(CBErr.CouchbaseNetworkError,))
+atexit.register(connections.close)
+bucket = connections.proxy()
 
+# A forked child (e.g. a worker process) can't use the parent's handles or threads either: it forgets the
+# handles and thread pool kept below (they're opened again on first use) and starts its own health monitor
+def afterFork():
+    global nodeMap, healthMonitor, replicaBucket, hedgePool, asyncBucket
+    nodeMap = (None, [], 0)
+    interval = healthMonitor.interval if healthMonitor is not None else None
+    healthMonitor = None
+    replicaBucket = None
+    hedgePool = ThreadPoolExecutor(max_workers=16)
+    asyncBucket = None
+    if interval is not None:
+        threading.Thread(target=startHealthMonitor, args=(interval,), daemon=True).start()
+
+os.register_at_fork(after_in_child=afterFork)
+
+# Short description of an error, e.g. for logging
 def getHint(err):
-    return str(err).split(", ")[1]
+    return describe(err)
 
 # Custom error class 
 class RetriesExceededException(Exception):
     pass
 
+# --== Error policies ==--
+# What each kind of operation does about each error, set here rather than in every helper's except
+# clauses (see errorPolicy.py). Errors without a rule are raised to the caller. Replacing an entry,
+# e.g. policies['retryRead'] = ErrorPolicy().on(...), changes every helper doing that kind of operation
+TRANSIENT = (CBErr.TimeoutError, CBErr.CouchbaseNetworkError, CBErr.TemporaryFailError)
+policies = {
+    # A read that falls back to a replica straight away (getNormalOrReplica, getHedged)
+    'read': ErrorPolicy().on((CBErr.TimeoutError, CBErr.CouchbaseNetworkError), Action(REPLICA, reportNode=True)),
+    # A read that is retried first (getOrRetry, the batched and async reads)
+    'retryRead': ErrorPolicy().on(TRANSIENT, Action(RETRY, retries=2, delay=1000, reportNode=True)),
+    # A write whose outcome is then unknown, so it's checked by reading the document back
+    'write': ErrorPolicy().on(TRANSIENT, Action(VERIFY, retries=4, delay=1000, reportNode=True)),
+}
+
+def actionFor(op, err):
+    return policies[op].actionFor(err)
+
+# Same for a result from a batch operation, which has an error code rather than an exception
+def resultAction(op, result):
+    return policies[op].actionForRC(result.rc, CBErr.CouchbaseError.rc_to_exctype)
+
+# --== Retry budget ==--
+# Every retry below is paid for from this one budget (see retryBudget.py),
+# so when a node drops the extra load is capped rather than multiplied by every request in flight
+retryBudget = RetryBudget()
+# Replica reads after the active copy failed have their own, larger budget. They go to the nodes
+# that are still up, so they don't hold the failed node's retry slots (they take its slots in this
+# budget, of which there are more), and they must not be starved by retries: with one of three
+# nodes down about a third of reads need one (hence ratio=0.5)
+replicaBudget = RetryBudget(ratio=0.5, minPerSecond=50, maxTokens=500, perNodeConcurrency=64)
+
+# Successful first attempts earn tokens for both
+def recordSuccess(n=1):
+    retryBudget.recordSuccess(n)
+    replicaBudget.recordSuccess(n)
+
+# Node holding the active copy of docID, from the client's vbucket map.
+# It's asked of every call (for metrics), so one handle, its node list and the answers for keys
+# seen (up to NODE_CACHE_SIZE) are kept for NODE_MAP_TTL seconds rather than asking through the pool's proxy
+NODE_MAP_TTL = 1
+NODE_CACHE_SIZE = 65536
+nodeMap = (None, [], 0)
+nodeCache = {}
+
+def activeNode(docID):
+    node = nodeCache.get(docID)
+    if node is not None and time.monotonic() <= nodeMap[2]: return node
+    handle, hosts, expires = nodeMap
+    if handle is None or time.monotonic() > expires: handle, hosts, expires = refreshNodeMap()
+    index = handle._vbmap(docID)[1]
+    if index >= len(hosts): handle, hosts, expires = refreshNodeMap()
+    if len(nodeCache) >= NODE_CACHE_SIZE: nodeCache.clear()
+    node = nodeCache[docID] = hosts[index]
+    return node
+
+def refreshNodeMap():
+    global nodeMap
+    handle = connections.get()
+    nodeCache.clear()
+    nodeMap = (handle, [n.split(':')[0] for n in handle.server_nodes], time.monotonic() + NODE_MAP_TTL)
+    return nodeMap
+
+# Replica read after the active copy failed. Raises RetryBudgetExceededException if the replica budget is spent
+def replicaFallback(docID, source=None):
+    with span('replica'), replicaBudget.spend(activeNode(docID)):
+        return kvCall('replica', docID, lambda b: b.get(docID, replica=True), source)
+
+# --== Metrics ==--
+# The helpers record how each call resolved and how long it took, per function, outcome and
+# the key's active node (see metrics.py): metrics.snapshot() or metrics.writePrometheus(path).
+# Outcomes are the below; primary, retry, replica and failed are also used by the batched helpers
+PRIMARY, RETRY, REPLICA, FAILED = 'primary', 'retry', 'replica', 'failed'
+ACTIVE, NODE_DOWN, EXHAUSTED, BUDGET = 'active', 'nodeDown', 'exhausted', 'budget'
+HEDGED, CONFIRMED_LATE, JOURNALED = 'hedged', 'confirmedLate', 'journaled'
+
+# Called from finally blocks, so it mustn't raise: that would replace the call's own error
+def recordCall(function, outcome, docID, start):
+    try:
+        node = activeNode(docID)
+    except Exception:
+        # Looking the node up can need a connection, which may be what just failed
+        node = ''
+    metrics.record(function, outcome, node, time.perf_counter() - start)
+
+# --== Adaptive timeouts ==--
+adaptiveTimeouts = None
+
+# Once enabled, KV operations made by the helpers get a timeout worked out from the latency
+# recently seen for that node and operation (see adaptiveTimeout.py), instead of the fixed 2.5s.
+# NB: the SDK's timeout is per bucket object, so each call holds the connection (connections.lockFor)
+# while it sets the timeout, runs and puts the timeout back
+def enableAdaptiveTimeouts(floor=0.02, ceiling=2.5, multiplier=3):
+    global adaptiveTimeouts
+    adaptiveTimeouts = AdaptiveTimeouts(floor, ceiling, multiplier)
+    return adaptiveTimeouts
+
+# Runs fn(bucket), a KV operation on docID, under the adaptive timeout (if enabled) and records how long it took.
+# source is the bucket to use, by default one from the pool (the timeout is set on that connection only)
+# A success on the active copy is reported to the key's breaker (see reportNodeSuccess)
+def kvCall(op, docID, fn, source=None):
+    if adaptiveTimeouts is None:
+        result = fn(source or bucket)
+        if op != 'replica': reportNodeSuccess(docID)
+        return result
+    node = activeNode(docID)
+    timeout = adaptiveTimeouts.timeoutFor(node, op)
+    b = source or connections.get()
+    with connections.lockFor(b):
+        previous = b.timeout
+        b.timeout = timeout
+        start = time.perf_counter()
+        try:
+            result = fn(b)
+        except CBErr.TimeoutError:
+            adaptiveTimeouts.record(node, op, timeout, timedOut=True)
+            raise
+        except CBErr.NotFoundError:
+            # Still a normal answer from the node
+            adaptiveTimeouts.record(node, op, time.perf_counter() - start)
+            raise
+        finally:
+            b.timeout = previous
+    adaptiveTimeouts.record(node, op, time.perf_counter() - start)
+    if op != 'replica': reportNodeSuccess(docID)
+    return result
+
+# --== Node health ==--
+healthMonitor = None
+
+# Starts pinging the cluster in the background. While it runs, reads of keys whose
+# active node is down go straight to a replica and writes to that node fail fast
+def startHealthMonitor(interval=1):
+    global healthMonitor
+    if healthMonitor is None:
+        healthMonitor = HealthMonitor(connections.open(), interval).start()
+    return healthMonitor
+
+# Once the node's breaker is half-open, the first caller gets False and makes the trial request
+def nodeIsDown(docID):
+    return healthMonitor is not None and healthMonitor.keyIsOpen(docID)
+
+# Same, without taking the trial request (for checks that don't go on to make the request themselves)
+def nodeMarkedDown(docID):
+    return healthMonitor is not None and healthMonitor.keyIsDown(docID)
+
+# Timeouts and network errors count against the node's breaker as well as failed pings
+def reportNodeError(docID):
+    if healthMonitor is not None:
+        healthMonitor.recordResult(healthMonitor.nodeForKey(docID), False)
+
+# and successes reset it, so only errors in a row open it
+def reportNodeSuccess(docID):
+    if healthMonitor is not None:
+        healthMonitor.recordResult(healthMonitor.nodeForKey(docID), True)
 
 # First tries a normal get, and if the request times out, tries to get the replica
-def getNormalOrReplica(docID):
+# With hedge=True the replica read is started early instead (see getHedged)
+@traced()
+def getNormalOrReplica(docID, hedge=False):
+    start = time.perf_counter()
+    outcome = FAILED
     try:
-        result = bucket.get(docID)
-    except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError) as e:
-        result = bucket.get(docID, replica=True)
-    except Exception as e:
-        raise e
+        if nodeIsDown(docID):
+            result = bucket.get(docID, replica=True)
+            outcome = NODE_DOWN
+            return result
+        if hedge:
+            outcome = HEDGED
+            return getHedged(docID)
+        try:
+            result = kvCall('get', docID, lambda b: b.get(docID))
+            recordSuccess()
+            outcome = PRIMARY
+        except CBErr.CouchbaseError as e:
+            action = actionFor('read', e)
+            if action.kind != REPLICA: raise
+            if action.reportNode: reportNodeError(docID)
+            result = replicaFallback(docID)
+            outcome = REPLICA
+        return result
+    finally:
+        if outcome != HEDGED: recordCall('getNormalOrReplica', outcome, docID, start)
+
+# --== Hedged reads ==--
+# Rather than waiting out the full KV timeout (~2.5s) before reading a replica,
+# fire the replica read once the primary is slower than HEDGE_PERCENTILE of
+# recent primary gets, and take whichever answer arrives first
+HEDGE_PERCENTILE = 95
+# Hedge delay (seconds) used until enough primary latencies have been seen
+HEDGE_DEFAULT_DELAY = 0.05
+HEDGE_MIN_SAMPLES = 20
+hedgeLatencies = deque(maxlen=1000)
+# calls: hedged reads made, fired: replica read was started,
+# primary/replica: which side answered, fallback: replica read after a primary error
+hedgeStats = {'calls': 0, 'fired': 0, 'primary': 0, 'replica': 0, 'fallback': 0}
+hedgeLock = threading.Lock()
+hedgePool = ThreadPoolExecutor(max_workers=16)
+replicaBucket = None
+
+# Replica reads get their own connection so they aren't stuck behind
+# a slow primary read holding the main bucket's lock
+def getReplicaBucket():
+    global replicaBucket
+    with hedgeLock:
+        if replicaBucket is None:
+            replicaBucket = connections.open()
+    return replicaBucket
+
+def countHedge(stat, docID=None):
+    with hedgeLock:
+        hedgeStats[stat] += 1
+    metrics.count('getHedged', stat, activeNode(docID) if docID else '')
+
+def getHedgeStats():
+    with hedgeLock:
+        return dict(hedgeStats)
+
+# Seconds to wait on the primary before hedging
+def hedgeDelay(percentile=HEDGE_PERCENTILE):
+    with hedgeLock:
+        samples = sorted(hedgeLatencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return samples[min(len(samples)-1, int(len(samples) * percentile / 100))]
+
+def timedGet(docID):
+    start = time.perf_counter()
+    result = kvCall('get', docID, lambda b: b.get(docID))
+    with hedgeLock:
+        hedgeLatencies.append(time.perf_counter() - start)
     return result
 
+def replicaGet(docID):
+    return getReplicaBucket().get(docID, replica=True)
+
+# Same as getNormalOrReplica, but hedges rather than waiting for a timeout.
+# The losing read can't be aborted once sent, so its result is ignored
+def getHedged(docID, percentile=HEDGE_PERCENTILE):
+    countHedge('calls', docID)
+    primary = hedgePool.submit(timedGet, docID)
+    done, _ = wait([primary], timeout=hedgeDelay(percentile))
+    # A hedge is extra load too, without budget (or a slot on the node) just wait for
+    # the primary, and fall back as getNormalOrReplica does
+    slot = None if done else retryBudget.trySpend(activeNode(docID))
+    if slot is None:
+        try:
+            result = primary.result()
+        except CBErr.CouchbaseError as e:
+            action = actionFor('read', e)
+            if action.kind != REPLICA: raise
+            if action.reportNode: reportNodeError(docID)
+            countHedge('fallback', docID)
+            return replicaFallback(docID, getReplicaBucket())
+        recordSuccess()
+        countHedge('primary', docID)
+        return result
+    countHedge('fired', docID)
+    with slot:
+        replica = hedgePool.submit(replicaGet, docID)
+        pending = {primary, replica}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    for other in pending: other.cancel()
+                    if f is primary: recordSuccess()
+                    countHedge('primary' if f is primary else 'replica', docID)
+                    return f.result()
+        # Both sides failed, report the primary's error
+        return primary.result()
+
 # Gets with retries if first attempt fails.
 # Backoff factor can somewhat mitigate overloading the server with too many Gets at once
-def getOrRetry(docID, retries=2, delay=1000, backoff_factor=1):
-    if retries <= -1: raise RetriesExceededException
+# Which errors are retried, how often and how far apart comes from policies['retryRead'];
+# retries, delay and backoff_factor override the policy's when given
+# Gives up straight away if the key's node is known to be down or the retry budget is spent
+@traced()
+def getOrRetry(docID, retries=None, delay=None, backoff_factor=None):
+    start = time.perf_counter()
+    outcome = FAILED
+    slot = None
+    attempt = 0
     try:
-        result = bucket.get(docID)
-    except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError, CBErr.TemporaryFailError) as e:
-        time.sleep(delay/1000)
-        return getOrRetry(docID, retries-1, delay*backoff_factor)
-    except Exception as e:
-        raise e
-    return result
+        while not nodeIsDown(docID):
+            try:
+                attempt += 1
+                with span('attempt', attempt=attempt):
+                    result = kvCall('get', docID, lambda b: b.get(docID))
+                if slot is None: recordSuccess()
+                outcome = PRIMARY if attempt == 1 else RETRY
+                return result
+            except CBErr.CouchbaseError as e:
+                action = actionFor('retryRead', e)
+                if action.kind != RETRY: raise
+                if action.reportNode: reportNodeError(docID)
+                if attempt > (action.retries if retries is None else retries): break
+                # Each retry costs a token. The first also holds one of the node's retry slots until we're done
+                if slot is None: slot = retryBudget.spend(activeNode(docID))
+                else: retryBudget.spend()
+                pause = action.backoff(attempt, delay, backoff_factor)
+                with span('backoff', ms=pause):
+                    time.sleep(pause/1000)
+        outcome = EXHAUSTED if attempt else NODE_DOWN
+    except RetryBudgetExceededException as e:
+        outcome = BUDGET
+        raise RetriesExceededException("Retry budget exhausted for key " + docID) from e
+    finally:
+        if slot is not None: slot.release()
+        recordCall('getOrRetry', outcome, docID, start)
+    raise RetriesExceededException
 
 # Retries, then falls back to getting a replica
 # Is VERY slow to time out. Can we decrease the timeout? check the node is up? etc.
-def getRetryThenReplica(docID):
+# Outcome is active (the active copy answered, see getOrRetry's metrics for how many tries it took) or replica
+@traced()
+def getRetryThenReplica(docID, retries=None, delay=None):
+    start = time.perf_counter()
+    outcome = FAILED
     try:
-        result = getOrRetry(docID)
-    except RetriesExceededException:
-        result = bucket.get(docID, replica=True)
-    return result
+        try:
+            result = getOrRetry(docID, retries, delay)
+            outcome = ACTIVE
+        except RetriesExceededException:
+            result = replicaFallback(docID)
+            outcome = REPLICA
+        return result
+    finally:
+        recordCall('getRetryThenReplica', outcome, docID, start)
 
-# Returns True/False if upsert was/wasn't completed
-# In the event of an error, outcome is still unknown.
-# In this case, retrying the whole operation is valid
-def upsertAndCheck(docID, value):
+# --== Request coalescing ==--
+# Concurrent reads of the same key share one in-flight read, retries and replica fallback
+# included, so a hot key on a struggling node costs one sequence of requests rather than one per caller
+readFlights = SingleFlight()
+
+def getNormalOrReplicaShared(docID):
+    return readFlights.do(('getNormalOrReplica', docID), lambda: getNormalOrReplica(docID))
+
+def getRetryThenReplicaShared(docID, retries=None, delay=None):
+    return readFlights.do(('getRetryThenReplica', docID, retries, delay), lambda: getRetryThenReplica(docID, retries, delay))
+
+def getActiveShared(docID):
+    return readFlights.do(('getActive', docID), lambda: getActive(docID))
+
+# --== Reference data cache ==--
+# Airport and airline documents are almost entirely static, so most reads can be served locally.
+# Misses go through the shared reads, so a burst of misses on one key makes one request.
+# An expired entry is refreshed from the active copy only (getActive): if that fails or the key's node
+# is down, the last copy is served straight away and read again, replica fallback and all, in the background
+referenceCache = DocCache(getNormalOrReplicaShared, ttl=300, isDown=nodeMarkedDown, refresh=getActiveShared,
+    staleOn=(CBErr.TimeoutError, CBErr.CouchbaseNetworkError, NodeUnavailableException, RetryBudgetExceededException))
+retryingReferenceCache = DocCache(getRetryThenReplicaShared, ttl=300, isDown=nodeMarkedDown, refresh=getActiveShared,
+    staleOn=(CBErr.TimeoutError, CBErr.CouchbaseNetworkError, NodeUnavailableException, RetriesExceededException, RetryBudgetExceededException))
+
+# One read of the active copy, no retry or fallback. Errors are reported to the node and raised
+@traced()
+def getActive(docID):
+    start = time.perf_counter()
+    outcome = FAILED
+    try:
+        try:
+            result = kvCall('get', docID, lambda b: b.get(docID))
+        except CBErr.CouchbaseError as e:
+            if actionFor('read', e).reportNode: reportNodeError(docID)
+            raise
+        recordSuccess()
+        outcome = PRIMARY
+        return result
+    finally:
+        recordCall('getActive', outcome, docID, start)
+
+# Cached getNormalOrReplica / getRetryThenReplica
+def getCached(docID):
+    return referenceCache.get(docID)
+
+def getCachedWithRetries(docID):
+    return retryingReferenceCache.get(docID)
+
+# --== Host-wide reference cache ==--
+# With several worker processes each one's cache misses separately, so every worker reads each document
+# from the cluster and holds its own copy. enableSharedCache() puts a cache shared by all the processes
+# on the host (see sharedCache.py) below the per-process caches: a miss there is read from the cluster
+# once per host per ttl, and served to the other workers from shared memory.
+# Its ttl adds to the per-process one (a local entry can be refreshed from a shared one up to ttl old),
+# so it's kept shorter
+SHARED_CACHE_NAME = 'cb-reference-cache'
+sharedCache = None
+
+def enableSharedCache(name=SHARED_CACHE_NAME, ttl=60, **options):
+    global sharedCache
+    if sharedCache is None:
+        sharedCache = SharedCache(name, **options)
+        for cache in (referenceCache, retryingReferenceCache):
+            cache.fetch = sharedCache.readThrough(cache.fetch, ttl, cache.staleOn)
+            cache.refresh = sharedCache.readThrough(cache.refresh, ttl, cache.staleOn)
+    return sharedCache
+
+# --== Batched retries ==--
+# getRetryThenReplica for many keys at once: one pipelined get_multi, then
+# only the keys that failed transiently are retried, and whatever is still
+# failing goes to a single replica get_multi.
+# Returns {key: (outcome, result)} where outcome is PRIMARY, RETRY, REPLICA or FAILED
+
+# get_multi that doesn't raise, failed keys are left in the result with success == False
+def getMultiResults(keys, **kwargs):
+    try:
+        return bucket.get_multi(keys, **kwargs)
+    except CBErr.CouchbaseError as e:
+        return e.all_results
+
+# Keys whose active node is down skip straight to the replica read
+# Retries are paced by policies['retryRead'] (the slowest pacing among the failed keys' errors, as they're
+# retried together); retries, delay and backoff_factor override it when given
+def getRetryThenReplicaMulti(keys, retries=None, delay=None, backoff_factor=None):
+    start = time.perf_counter()
+    outcomes = {}
+    # Asked once per key: a half-open node lets the first key through as its trial
+    isDown = {k: nodeIsDown(k) for k in keys}
+    down = [k for k in keys if isDown[k]]
+    pending = [k for k in keys if not isDown[k]] if down else list(keys)
+    outcome = PRIMARY
+    attempt = 0
+    slot = None
+    try:
+        while pending:
+            res = getMultiResults(pending)
+            attempt += 1
+            pending = []
+            pace = None
+            for k, v in res.items():
+                if v.success:
+                    outcomes[k] = (outcome, v)
+                    reportNodeSuccess(k)
+                    continue
+                action = resultAction('retryRead', v)
+                if action.kind == RETRY:
+                    if action.reportNode: reportNodeError(k)
+                    pending.append(k)
+                    if pace is None or action.backoff(attempt) > pace.backoff(attempt): pace = action
+                else:
+                    outcomes[k] = (FAILED, v)
+            if outcome == PRIMARY: recordSuccess(len(res) - len(pending))
+            if not pending or attempt > (pace.retries if retries is None else retries): break
+            # Each retry or replica round trip costs a token, however many keys it carries: charging
+            # per key would shed every batch with more failed keys than the budget can ever hold.
+            # The first retry also holds a slot on each of the failed keys' nodes until we're done
+            if slot is None:
+                slot = retryBudget.trySpend({activeNode(k) for k in pending})
+                if slot is None: break
+            elif not retryBudget.tryAcquire(): break
+            time.sleep(pace.backoff(attempt, delay, backoff_factor)/1000)
+            outcome = RETRY
+    finally:
+        if slot is not None: slot.release()
+    replicaSlot = replicaBudget.trySpend({activeNode(k) for k in pending}) if pending else None
+    if pending and replicaSlot is None:
+        for k in pending: outcomes[k] = (FAILED, res[k])
+        pending = []
+    pending += down
+    if pending:
+        try:
+            for k, v in getMultiResults(pending, replica=True).items():
+                outcomes[k] = (REPLICA if v.success else FAILED, v)
+        finally:
+            if replicaSlot is not None: replicaSlot.release()
+    # Per-key outcomes are counted, the batch is timed as a whole
+    metrics.record('getRetryThenReplicaMulti', 'batch', '', time.perf_counter() - start)
+    for k, (outcome, v) in outcomes.items():
+        metrics.count('getRetryThenReplicaMulti', outcome, activeNode(k))
+    return outcomes
+
+# --== Asyncio retries ==--
+# The helpers above block a thread for every second spent backing off.
+# These versions run on one event loop, so thousands of retries can be waiting at once
+asyncBucket = None
+
+async def getAsyncBucket():
+    global asyncBucket
+    if asyncBucket is None:
+        b = AsyncBucket(CONN_STR + '/travel-sample', username=USERNAME, password=PASSWORD)
+        await b.connect()
+        asyncBucket = b
+    return asyncBucket
+
+# Awaits op() until it succeeds, giving up once deadline seconds have passed (an attempt still
+# running then is cancelled, so the deadline holds whatever the KV timeout).
+# Between attempts sleeps a random time up to the policy's backoff for the error ("full jitter"),
+# so clients that failed together don't all retry together. Errors policies[policy] doesn't retry are raised.
+# base (the first backoff) and cap, in seconds, override the policy's delay and maxDelay when given.
+# The first retry also holds a slot on node (the one op goes to, if given) until we're done, as in getOrRetry
+# Retries hold a slot on node (the one op goes to, if given) until we're done, as in getOrRetry
+async def retryAsync(op, deadline=5, base=None, cap=None, policy='retryRead', node=None):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    attempt = 0
+    slot = None
+    try:
+        while True:
+            try:
+                result = await asyncio.wait_for(op(), end - loop.time())
+                if attempt == 0: recordSuccess()
+                return result
+            except asyncio.TimeoutError:
+                raise RetriesExceededException("Deadline exceeded after " + str(attempt+1) + " attempts") from None
+            except CBErr.CouchbaseError as e:
+                action = actionFor(policy, e)
+                if action.kind != RETRY: raise
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    raise RetriesExceededException("Deadline exceeded after " + str(attempt+1) + " attempts") from e
+                if slot is None: slot = retryBudget.trySpend(node)
+                if slot is None or (attempt and not retryBudget.tryAcquire()):
+                    raise RetriesExceededException("Retry budget exhausted after " + str(attempt+1) + " attempts") from e
+                bound = action.backoff(attempt + 1, None if base is None else base * 1000) / 1000
+                if cap is not None: bound = min(cap, bound)
+                await asyncio.sleep(min(remaining, random.uniform(0, bound)))
+                attempt += 1
+    finally:
+        if slot is not None: slot.release()
+
+async def getOrRetryAsync(docID, deadline=5, base=None, cap=None):
+    if nodeIsDown(docID): raise RetriesExceededException("Node for key " + docID + " is down")
+    b = await getAsyncBucket()
+    return await retryAsync(lambda: b.get(docID), deadline, base, cap, node=activeNode(docID))
+
+async def getRetryThenReplicaAsync(docID, deadline=5):
+    start = time.perf_counter()
+    outcome = FAILED
     try:
-        oldCAS = bucket.get(docID).cas
-    except CBErr.NotFoundError:
-        oldCAS = False
+        try:
+            result = await getOrRetryAsync(docID, deadline)
+            outcome = ACTIVE
+        except RetriesExceededException:
+            slot = replicaBudget.trySpend(activeNode(docID))
+            if slot is None:
+                outcome = BUDGET
+                raise RetryBudgetExceededException("Retry budget exhausted")
+            with slot:
+                b = await getAsyncBucket()
+                result = await b.get(docID, replica=True)
+            outcome = REPLICA
+        return result
+    finally:
+        recordCall('getRetryThenReplicaAsync', outcome, docID, start)
+
+asyncReadFlights = AsyncSingleFlight()
+
+# Coalesced getRetryThenReplicaAsync, see getRetryThenReplicaShared
+async def getRetryThenReplicaAsyncShared(docID, deadline=5):
+    return await asyncReadFlights.do((docID, deadline), lambda: getRetryThenReplicaAsync(docID, deadline))
+
+# Same protocol as upsertAndCheck
+async def upsertAndCheckAsync(docID, value, deadline=5):
+    if nodeIsDown(docID): raise NodeUnavailableException("Node for key " + docID + " is down")
+    start = time.perf_counter()
+    outcome = FAILED
+    b = await getAsyncBucket()
     try:
-        bucket.upsert(docID, value)
+        await b.upsert(docID, value)
+        outcome = CONFIRMED
         return True
-    except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError ,CBErr.TemporaryFailError):
+    except CBErr.CouchbaseError as e:
+        if actionFor('write', e).kind != VERIFY: raise
         try:
-            res = getOrRetry(docID, 4, 1000)
-            # If there's no oldCAS and we got the document (ie: no error), insert successful
-            # otherwise, an different CAS value means an operation was performed
-            return (not oldCAS) or (res.cas != oldCAS)
+            res = await getOrRetryAsync(docID, deadline)
+            outcome = CONFIRMED_LATE if res.value == value else NOT_APPLIED
+            return res.value == value
         except RetriesExceededException:
+            outcome = UNKNOWN
             raise RetriesExceededException("Couldn't confirm or deny operation on key " + docID)
         except CBErr.NotFoundError:
+            outcome = NOT_APPLIED
             return False
-        except Exception as e:
-            raise e
+    finally:
+        recordCall('upsertAndCheckAsync', outcome, docID, start)
+
+# Returns True/False if upsert was/wasn't completed
+# In the event of an error, outcome is still unknown.
+# In this case, retrying the whole operation is valid
+# Raises NodeUnavailableException without trying if the key's node is known to be down
+# With journaled=True an ambiguous write is journaled instead of checked on the spot and None
+# is returned straight away; the reconciler then checks (and if need be redoes) it later.
+# preCAS, the document's CAS when the caller read it, lets the reconciler tell a newer write from ours;
+# without it a journaled write that didn't land is reported (unverified) rather than redone
+# The check is paced by policies['write'] unless retries and delay are given
+@traced()
+def upsertAndCheck(docID, value, retries=None, delay=None, journaled=False, preCAS=0):
+    start = time.perf_counter()
+    outcome = FAILED
+    try:
+        if nodeIsDown(docID):
+            outcome = NODE_DOWN
+            raise NodeUnavailableException("Node for key " + docID + " is down")
+        try:
+            kvCall('upsert', docID, lambda b: b.upsert(docID, value))
+            recordSuccess()
+            outcome = CONFIRMED
+            return True
+        except CBErr.CouchbaseError as e:
+            action = actionFor('write', e)
+            if action.kind != VERIFY: raise
+            if action.reportNode: reportNodeError(docID)
+            if journaled:
+                startJournal().append(docID, value, preCAS)
+                outcome = JOURNALED
+                return None
+            try:
+                with span('casCheck'):
+                    res = getOrRetry(docID, action.retries if retries is None else retries, action.delay if delay is None else delay)
+                # Only read the document back when the outcome is unknown (no pre-read on the happy path).
+                # If it now holds our value the upsert was applied - or an identical write got there,
+                # which leaves the document in the same state
+                outcome = CONFIRMED_LATE if res.value == value else NOT_APPLIED
+                return res.value == value
+            except RetriesExceededException:
+                outcome = UNKNOWN
+                raise RetriesExceededException("Couldn't confirm or deny operation on key " + docID)
+            except CBErr.NotFoundError:
+                outcome = NOT_APPLIED
+                return False
+    finally:
+        recordCall('upsertAndCheck', outcome, docID, start)
+
+# Batched upsertAndCheck. Writes every item with one upsert_multi, then reads back
+# only the keys whose outcome is ambiguous with one get_multi.
+# Keys whose node is known to be down aren't sent, they come back not-applied straight away.
+# Returns {key: status} where status is one of the below
+CONFIRMED, NOT_APPLIED, UNKNOWN = 'confirmed', 'not-applied', 'unknown'
+
+def upsertAndCheck_multi(items):
+    start = time.perf_counter()
+    statuses = {k: NOT_APPLIED for k in items if nodeIsDown(k)}
+    if statuses: items = {k: v for k, v in items.items() if k not in statuses}
+    try:
+        res = bucket.upsert_multi(items) if items else {}
+    except CBErr.CouchbaseError as e:
+        res = e.all_results
+    ambiguous = []
+    for k, v in res.items():
+        if v.success:
+            statuses[k] = CONFIRMED
+            reportNodeSuccess(k)
+            continue
+        action = resultAction('write', v)
+        if action.kind == VERIFY:
+            if action.reportNode: reportNodeError(k)
+            ambiguous.append(k)
+        else:
+            # The server refused the write (e.g. value too large)
+            statuses[k] = NOT_APPLIED
+    recordSuccess(len(res) - len(ambiguous))
+    # Checking costs a token (one get_multi, see getRetryThenReplicaMulti) and a slot on each of the keys' nodes,
+    # without them the outcome stays unknown
+    slot = retryBudget.trySpend({activeNode(k) for k in ambiguous}) if ambiguous else None
+    if ambiguous and slot is None:
+        for k in ambiguous: statuses[k] = UNKNOWN
+        ambiguous = []
+    if ambiguous:
+        with slot:
+            res = getMultiResults(ambiguous)
+        for k, v in res.items():
+            if v.success:
+                statuses[k] = CONFIRMED if v.value == items[k] else NOT_APPLIED
+            elif issubclass(CBErr.CouchbaseError.rc_to_exctype(v.rc), CBErr.NotFoundError):
+                statuses[k] = NOT_APPLIED
+            else:
+                statuses[k] = UNKNOWN
+    metrics.record('upsertAndCheck_multi', 'batch', '', time.perf_counter() - start)
+    for k, status in statuses.items():
+        metrics.count('upsertAndCheck_multi', status, activeNode(k))
+    return statuses
+
+# --== Write-behind ==--
+# For writes where last-write-wins is fine: upsertBehind() returns at once, repeated writes to a key
+# collapse into one, and the buffer is written in upsertAndCheck_multi batches in the background
+# (see writeBehind.py). Anything still buffered is written when the process exits
+writeBehind = None
+
+def startWriteBehind(**options):
+    global writeBehind
+    if writeBehind is None:
+        writeBehind = WriteBehindBuffer(upsertAndCheck_multi, **options)
+        atexit.register(writeBehind.close)
+    return writeBehind
+
+def upsertBehind(docID, value):
+    startWriteBehind().put(docID, value)
+
+# --== Reconciliation journal ==--
+# Writes journaled by upsertAndCheck(..., journaled=True) are kept in a local memory mapped file
+# (see journal.py) and checked in batches in the background, so the caller doesn't wait on the check.
+# The journal is replayed when it's opened, so writes left unresolved by a previous run are checked too:
+# call resumeJournal() at startup (warmUp does) so that happens straight away, not on this run's first journaled write.
+# Each journaled write is resolved as one of
+APPLIED, REAPPLIED, SUPERSEDED, REJECTED, UNVERIFIED = 'applied', 'reapplied', 'superseded', 'rejected', 'unverified'
+JOURNAL_PATH = 'upserts.journal'
+journal = None
+reconciler = None
+
+def startJournal(path=JOURNAL_PATH, **options):
+    global journal, reconciler
+    if journal is None:
+        journal = Journal(path)
+        reconciler = Reconciler(journal, reconcileBatch, failedOutcomes=(REJECTED, UNVERIFIED), **options).start()
+        atexit.register(reconciler.stop)
+    return journal
+
+# Opens the journal and starts reconciling if a previous run left one. Returns how many writes are open
+def resumeJournal(path=JOURNAL_PATH):
+    if journal is None and not os.path.exists(path): return 0
+    return len(startJournal(path).openEntries())
+
+# One get_multi for the batch:
+#   holds our value -> applied
+#   preCAS known, unchanged since -> written again by a replace guarded by preCAS: reapplied, or
+#                                    superseded if someone else got there in between
+#   preCAS known, changed or deleted since -> superseded, ours is left alone
+#   preCAS unknown, missing -> written again by an insert (which fails if the document exists by then):
+#                                    reapplied, or superseded if someone else created it in between
+#   preCAS unknown, doesn't hold our value -> unverified: a later write by someone else can't be told
+#                                    from ours not landing, so it isn't redone (it goes to onFailure)
+# Entries whose check or rewrite fails transiently are left for the next pass
+def reconcileBatch(entries):
+    byKey = {e.key: e for e in entries}
+    outcomes = {}
+    for k, v in getMultiResults(list(byKey)).items():
+        e = byKey[k]
+        missing = not v.success and issubclass(CBErr.CouchbaseError.rc_to_exctype(v.rc), CBErr.NotFoundError)
+        if v.success and valueHash(v.value) == e.valueHash: outcomes[e] = APPLIED
+        elif not v.success and not missing: continue
+        elif missing and not e.preCAS:
+            outcome = rewrite(e, 'insert', lambda b: b.insert(e.key, e.value))
+            if outcome is not None: outcomes[e] = outcome
+        elif not e.preCAS: outcomes[e] = UNVERIFIED
+        elif missing or v.cas != e.preCAS: outcomes[e] = SUPERSEDED
+        else:
+            outcome = rewrite(e, 'replace', lambda b: b.replace(e.key, e.value, cas=e.preCAS))
+            if outcome is not None: outcomes[e] = outcome
+    for e, outcome in outcomes.items():
+        metrics.count('reconcile', outcome, activeNode(e.key))
+    return outcomes
+
+# Writes the entry's value again with fn(bucket), a write that fails if the document has changed since
+# (a replace guarded by preCAS, or an insert). None if that's not known yet (the write failed transiently)
+def rewrite(e, op, fn):
+    try:
+        kvCall(op, e.key, fn)
+        return REAPPLIED
+    except (CBErr.KeyExistsError, CBErr.NotFoundError):
+        return SUPERSEDED
+    except CBErr.CouchbaseError as err:
+        return None if actionFor('write', err).kind == VERIFY else REJECTED
 
 # The ping method can be used to check which nodes are available
 # And also gives per-service information
 # This can be useful for diagnosing issues at the application level
+# If the health monitor is running its last results are used instead of pinging on the request path
 def getNodes():
-    print(bucket.ping())
-    # What do the status numbers mean??
+    if healthMonitor is not None: return healthMonitor.getNodes()
+    # A status of 0 means the node answered
     return [x['server'].split(':')[0] for x in bucket.ping()['kv'] if x['status'] == 0 ]
 
+# Statements run with prepared=True are planned once per connection and reused
+preparedStatements = PreparedStatements(bucket)
+
+def runQuery(statement, *params, prepared=False):
+    if prepared: return preparedStatements.query(statement, *params)
+    return bucket.n1ql_query(N1QLQuery(statement, *params))
+
+AIRPORT_QUERY = "SELECT airportname, city FROM `travel-sample` WHERE LOWER(airportname) LIKE $1"
+AIRPORT_SIMPLE_QUERY = "SELECT meta().id FROM `travel-sample` WHERE LOWER(airportname) LIKE $1"
+AIRPORT_FIELDS = ('airportname', 'city')
+
 # Gets N1QL data from replicas using a simpler n1ql query that uses only indexed info
-def N1QLFetchAirports(search, field='airportname'):
-    query = "SELECT airportname, city FROM `travel-sample` WHERE LOWER(airportname) LIKE $1"
-    simple_query = "SELECT meta().id FROM `travel-sample` WHERE LOWER(airportname) LIKE $1"
+# If the local airport index is loaded (see loadAirportIndex) name searches are answered from it instead.
+# With fields, e.g. ('airportname', 'city'), rows from either path are read straight away into compact
+# records holding just those fields (or columns with columnar=True), see projection.py.
+# That way the fallback also kicks in when the full query fails part way through its rows
+@traced()
+def N1QLFetchAirports(search, field='airportname', prepared=False, fields=None, columnar=False):
+    if airportIndex is not None and field == 'airportname':
+        try:
+            with span('local'):
+                res = localFetchAirports(search)
+            return project(res.values(), fields, columnar) if fields else res
+        except (LocalSearchIncompleteException, CBErr.CouchbaseError, RetryBudgetExceededException):
+            # Some matches couldn't be read, the queries below may still get them
+            metrics.count('N1QLFetchAirports', 'localFailed', '')
     param = "%" + search.lower() + "%"
     res = False
     try:
-        q = N1QLQuery(query, param)
-        res = bucket.n1ql_query(q)
+        res = runQuery(AIRPORT_QUERY, param, prepared=prepared)
+        if fields: res = project(res, fields, columnar)
     except N1QLError as e:
-        q = N1QLQuery(simple_query, param)
-        docMetas = bucket.n1ql_query(q)
-        ids = [meta['id'] for meta in docMetas]
-        try:
-            res = bucket.get_multi(ids)
-        except CBErr.CouchbaseNetworkError as e:
-            res = e.all_results
-            failedKeys = [k for k,v in res.items() if v.value == None]
-            failedReplicas = bucket.get_multi(failedKeys, replica=True)
-            # TODO: Check for failed gets here too
-            res.update(failedReplicas)
+        with span('fallback'):
+            docMetas = runQuery(AIRPORT_SIMPLE_QUERY, param, prepared=prepared)
+            ids = [meta['id'] for meta in docMetas]
+            # Keys that couldn't be fetched from either the active or a replica copy are left out
+            res = {k: v for k, (outcome, v) in getRetryThenReplicaMulti(ids).items() if outcome != FAILED}
+            if fields: res = project(res.values(), fields, columnar)
     return res
-    
 
-# Load a couple of docs and write them back
-for j in range(1000):
-    for i in range(0,10):
-        keyname = "airline_1" + str(i)
-        try:
-            doc = bucket.get(keyname);
-            if doc and doc.value:
-                bucket.upsert(keyname, doc.value);
-        except:
+# --== Local airport search ==--
+# LIKE '%x%' can't use an index range, so every search scans, and fails outright with the index node down.
+# Instead the airport names can be kept in a local trigram index (see trigramIndex.py), built once from
+# the cluster and kept up to date from documents' CAS: refreshAirportIndex() asks for the airports
+# changed since the newest CAS in the index, and documents read during a search that have a newer CAS
+# than the index update it on the spot. Matching documents are fetched with batched KV reads.
+# If some of them can't be read N1QLFetchAirports runs its queries instead, as it does without an index.
+# NB: save() swaps the file under the index, don't run it while other threads are searching
+AIRPORT_INDEX_PATH = 'airports.trigrams'
+AIRPORT_INDEX_QUERY = "SELECT RAW [meta().id, airportname, meta().cas] FROM `travel-sample` WHERE type = 'airport' AND meta().cas > $1"
+airportIndex = None
+
+# Opens the index, building it from the cluster first if there isn't one (or rebuild=True)
+def loadAirportIndex(path=AIRPORT_INDEX_PATH, rebuild=False):
+    global airportIndex
+    if rebuild or not os.path.exists(path):
+        TrigramIndex.build(runQuery(AIRPORT_INDEX_QUERY, 0), path).close()
+    airportIndex = TrigramIndex(path)
+    return airportIndex
+
+# Returns how many airports had changed. With save=True the changes are written to the file too
+def refreshAirportIndex(save=False):
+    changed = sum(airportIndex.update(docID, name, cas) for docID, name, cas in runQuery(AIRPORT_INDEX_QUERY, airportIndex.maxCas()))
+    if save: airportIndex.save()
+    return changed
+
+# Raised by localFetchAirports when matching documents couldn't be read from either copy
+class LocalSearchIncompleteException(Exception):
+    pass
+
+def localFetchAirports(search, chunkSize=100):
+    res = {}
+    failed = 0
+    for chunk in chunks(airportIndex.search(search), chunkSize):
+        for k, (outcome, v) in getRetryThenReplicaMulti(chunk).items():
+            if outcome == FAILED:
+                if issubclass(CBErr.CouchbaseError.rc_to_exctype(v.rc), CBErr.NotFoundError): airportIndex.remove(k)
+                else: failed += 1
+                continue
+            name = v.value.get('airportname', '')
+            # Changed since it was indexed, and may no longer match
+            if airportIndex.update(k, name, v.cas) and search.lower() not in name.lower(): continue
+            res[k] = v
+    if failed: raise LocalSearchIncompleteException(str(failed) + " matching airports couldn't be read")
+    return res
+
+# --== Hedged N1QL ==--
+# N1QLFetchAirports only falls back once the full query has failed, which can take a whole query
+# timeout. N1QLFetchAirportsHedged starts the fallback (ids from the index, then documents by
+# get_multi, chunkSize at a time) once the full query has taken longer than delay seconds,
+# returns whichever finishes first and stops the other.
+# Both paths return a list of {'airportname', 'city'} rows, read to the end so errors show up here.
+# How long the losing full query would have taken is only known if it is left to finish, so a
+# sample (probeRate) of them is, and the time the hedge saved is recorded (n1qlHedgeStats, metrics).
+# NB: a cancelled path stops at its next row/chunk; a full query stuck waiting on the server
+# holds its worker until the SDK's query timeout
+N1QL_HEDGE_DELAY = 0.5
+N1QL_HEDGE_PROBE_RATE = 0.05
+# calls, fired: fallback started while the full query was running, fullError: fallback after the full query failed,
+# full/fallback: which path answered, probes/savedSeconds: losing full queries timed, and the total time saved on them
+n1qlHedgeStats = {'calls': 0, 'fired': 0, 'fullError': 0, 'full': 0, 'fallback': 0, 'probes': 0, 'savedSeconds': 0.0}
+n1qlPool = ThreadPoolExecutor(max_workers=16)
+
+def countN1QLHedge(stat, n=1):
+    with hedgeLock:
+        n1qlHedgeStats[stat] += n
+
+def getN1QLHedgeStats():
+    with hedgeLock:
+        return dict(n1qlHedgeStats)
+
+def airportsFull(param, prepared, cancelled):
+    rows = []
+    for row in runQuery(AIRPORT_QUERY, param, prepared=prepared):
+        if cancelled.is_set(): return None
+        rows.append(row)
+    return rows
+
+def airportsByIds(param, prepared, chunkSize, cancelled):
+    ids = (meta['id'] for meta in runQuery(AIRPORT_SIMPLE_QUERY, param, prepared=prepared))
+    rows = []
+    for chunk in chunks(ids, chunkSize):
+        if cancelled.is_set(): return None
+        for k, (outcome, v) in getRetryThenReplicaMulti(chunk).items():
+            if outcome != FAILED: rows.append({f: v.value.get(f) for f in AIRPORT_FIELDS})
+    return rows
+
+# Records how much sooner the fallback answered than the full query it beat would have
+def probeFullQuery(full, start, won, fallbackStarted):
+    def finished(f):
+        end = time.perf_counter()
+        # A failed full query would have been followed by the fallback, as in N1QLFetchAirports
+        wouldHaveTaken = end - start + (0 if f.exception() is None else won - fallbackStarted)
+        saved = max(0, wouldHaveTaken - (won - start))
+        countN1QLHedge('probes')
+        countN1QLHedge('savedSeconds', saved)
+        metrics.record('N1QLFetchAirportsHedged', 'saved', '', saved)
+    full.add_done_callback(finished)
+
+@traced()
+def N1QLFetchAirportsHedged(search, delay=N1QL_HEDGE_DELAY, chunkSize=100, prepared=False, probeRate=N1QL_HEDGE_PROBE_RATE):
+    param = "%" + search.lower() + "%"
+    start = time.perf_counter()
+    countN1QLHedge('calls')
+    fullCancelled, idsCancelled = threading.Event(), threading.Event()
+    full = n1qlPool.submit(airportsFull, param, prepared, fullCancelled)
+    done, _ = wait([full], timeout=delay)
+    if done and full.exception() is None:
+        countN1QLHedge('full')
+        metrics.record('N1QLFetchAirportsHedged', 'full', '', time.perf_counter() - start)
+        return full.result()
+    countN1QLHedge('fullError' if done else 'fired')
+    fallbackStarted = time.perf_counter()
+    byIds = n1qlPool.submit(airportsByIds, param, prepared, chunkSize, idsCancelled)
+    pending = {byIds} if done else {full, byIds}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is not None: continue
+            won = time.perf_counter()
+            if f is full:
+                idsCancelled.set()
+                countN1QLHedge('full')
+            else:
+                if full in pending:
+                    if random.random() < probeRate: probeFullQuery(full, start, won, fallbackStarted)
+                    else: fullCancelled.set()
+                countN1QLHedge('fallback')
+            metrics.record('N1QLFetchAirportsHedged', 'full' if f is full else 'fallback', '', won - start)
+            return f.result()
+    # Both paths failed, report the full query's error
+    metrics.record('N1QLFetchAirportsHedged', FAILED, '', time.perf_counter() - start)
+    return full.result()
+
+# --== Streaming N1QL ==--
+# Results are ordered by id so a query can resume from the last id seen (keyset pagination)
+STREAM_QUERY = "SELECT meta().id AS id, airportname, city FROM `travel-sample` WHERE LOWER(airportname) LIKE $1 AND meta().id > $2 ORDER BY meta().id"
+STREAM_SIMPLE_QUERY = "SELECT RAW meta().id FROM `travel-sample` WHERE LOWER(airportname) LIKE $1 AND meta().id > $2 ORDER BY meta().id"
+
+# Runs statement a page at a time (or in one go if pageSize is 0), yielding rows as they stream in
+def queryPages(statement, param, startAfter, pageSize, rowID, prepared=False):
+    if pageSize: statement += " LIMIT " + str(pageSize)
+    while True:
+        count = 0
+        for row in runQuery(statement, param, startAfter, prepared=prepared):
+            count += 1
+            startAfter = rowID(row)
+            yield row
+        if not pageSize or count < pageSize: return
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+# Generator version of N1QLFetchAirports, yields (id, {'airportname', 'city', ...}) as rows arrive
+# so memory stays flat however many airports match.
+# If the full query fails part way the fallback picks up after the last id already yielded,
+# fetching documents chunkSize at a time as the ids stream in.
+# startAfter resumes a previous search after the given id
+def N1QLStreamAirports(search, chunkSize=100, pageSize=0, startAfter='', prepared=False):
+    param = "%" + search.lower() + "%"
+    last = startAfter
+    try:
+        for row in queryPages(STREAM_QUERY, param, last, pageSize, lambda r: r['id'], prepared):
+            last = row.pop('id')
+            yield last, row
+    except N1QLError as e:
+        ids = queryPages(STREAM_SIMPLE_QUERY, param, last, pageSize, lambda r: r, prepared)
+        for chunk in chunks(ids, chunkSize):
+            for k, (outcome, v) in getRetryThenReplicaMulti(chunk).items():
+                if outcome != FAILED: yield k, v.value
+
+# --== Warm-up ==--
+# Run at startup before taking traffic (see warmup.py): opens the connection pool (which bootstraps and
+# fetches the cluster map), pings every node once, resumes reconciling any journal a previous run left
+# (see resumeJournal) and prefetches the hot documents into the reference caches in parallel get_multi batches. Keys whose node didn't answer the ping are read from a replica.
+# Ping latency per node is kept in nodeBaselines and recorded in metrics as warmUp/ping.
+# Returns the Warmup; with blocking=True once it's ready (done, or deadline seconds have passed)
+HOT_KEYS = ['airline_1' + str(i) for i in range(10)]
+warmup = None
+nodeBaselines = {}
+unreachableNodes = set()
+
+def warmUp(hotKeys=HOT_KEYS, deadline=10, batchSize=100, workers=4, blocking=True):
+    global warmup
+    warmup = Warmup(deadline)
+    warmup.phase('connect', lambda remaining: len(connections.openAll()))
+    warmup.phase('ping', pingNodes)
+    warmup.phase('journal', lambda remaining: resumeJournal())
+    warmup.phase('prefetch', lambda remaining: prefetch(hotKeys, remaining, batchSize, workers))
+    warmup.start()
+    if blocking: warmup.wait()
+    return warmup
+
+def pingNodes(remaining=None):
+    start = time.perf_counter()
+    report = connections.get().ping()['kv']
+    elapsed = time.perf_counter() - start
+    for x in report:
+        node = x['server'].split(':')[0]
+        up = x['status'] == 0
+        if healthMonitor is not None: healthMonitor.recordResult(node, up)
+        if not up:
+            unreachableNodes.add(node)
             continue
-time.sleep(20)
\ No newline at end of file
+        unreachableNodes.discard(node)
+        # Reports without per-node latency get the round trip of the whole ping
+        latency = x['latency_us'] / 1e6 if 'latency_us' in x else elapsed
+        nodeBaselines[node] = latency
+        metrics.record('warmUp', 'ping', node, latency)
+    return {'nodes': len(report), 'unreachable': sorted(unreachableNodes)}
+
+# Returns how many keys were fetched from the active copy, from a replica, failed, or weren't done in time
+def prefetch(keys, timeout=None, batchSize=100, workers=4):
+    counts = {'active': 0, 'replica': 0, 'failed': 0, 'pending': 0}
+    down = [k for k in keys if activeNode(k) in unreachableNodes]
+    up = [k for k in keys if activeNode(k) not in unreachableNodes] if down else list(keys)
+    def fetch(chunk, replica):
+        if replica: return {k: (REPLICA if v.success else FAILED, v) for k, v in getMultiResults(chunk, replica=True).items()}
+        return getRetryThenReplicaMulti(chunk, retries=0)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(fetch, chunk, False): chunk for chunk in chunks(up, batchSize)}
+    futures.update({pool.submit(fetch, chunk, True): chunk for chunk in chunks(down, batchSize)})
+    done, notDone = wait(futures, timeout=timeout)
+    pool.shutdown(wait=False)
+    for f in notDone: counts['pending'] += len(futures[f])
+    for f in done:
+        if f.exception() is not None:
+            counts['failed'] += len(futures[f])
+            continue
+        for k, (outcome, v) in f.result().items():
+            if outcome == FAILED:
+                counts['failed'] += 1
+                continue
+            counts['replica' if outcome == REPLICA else 'active'] += 1
+            for cache in (referenceCache, retryingReferenceCache):
+                cache.put(k, v)
+            if sharedCache is not None: sharedCache.put(k, v.value, v.cas)
+    return counts
+
+# Load a couple of docs and write them back
+if __name__ == "__main__":
+    warmUp()
+    for j in range(1000):
+        for i in range(0,10):
+            keyname = "airline_1" + str(i)
+            try:
+                doc = bucket.get(keyname);
+                if doc and doc.value:
+                    bucket.upsert(keyname, doc.value);
+            except:
+                continue
+    time.sleep(20)
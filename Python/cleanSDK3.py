@@ -1,8 +1,12 @@
-import couchbase, logging, json, random, time, sys
+import couchbase, logging, json, random, time, sys, threading, atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from couchbase.cluster import Cluster, ClusterOptions
 from couchbase_core.cluster import PasswordAuthenticator
 from couchbase_core.n1ql import N1QLQuery
 import couchbase.exceptions as CBErr
+from connections import ConnectionManager
+from errorPolicy import describe
 
 
 # Cluster address(es) and credentials
@@ -29,20 +33,33 @@ PASSWORD = 'password'
 # bucket.tracing_orphaned_queue_size=1000
 
 # Connect to the cluster and bucket
-authenticator = PasswordAuthenticator(USERNAME, PASSWORD)
-cluster = Cluster(CONN_STR, Cluster.ClusterOptions(authenticator))
-bucket = cluster.bucket('travel-sample')
-collection = bucket.default_collection()
-
+class Connection:
+    def __init__(self):
+        authenticator = PasswordAuthenticator(USERNAME, PASSWORD)
+        self.cluster = Cluster(CONN_STR, Cluster.ClusterOptions(authenticator))
+        self.bucket = self.cluster.bucket('travel-sample')
+        self.collection = self.bucket.default_collection()
+
+# Nothing connects at import, the first operation does (see connections.py).
+# An SDK3 cluster object is shared by all threads, so one connection per process is enough
+connections = ConnectionManager(Connection, poolSize=1, disconnect=lambda c: c.cluster.disconnect(), brokenOn=(CBErr.CouchbaseNetworkError,))
+atexit.register(connections.close)
+cluster = connections.proxy(lambda c: c.cluster)
+bucket = connections.proxy(lambda c: c.bucket)
+collection = connections.proxy(lambda c: c.collection)
+
+# Error class and code, without picking the message apart (see errorPolicy.py)
 def getHint(err):
-    return str(err).split(", ")[1]
+    return describe(err)
 
 # Custom error class 
 class RetriesExceededException(Exception):
     pass
 
 # First tries a normal get, and if the request times out, tries to get the replica
-def getNormalOrReplica(docID):
+# With hedge=True the replica read is started early instead (see getHedged)
+def getNormalOrReplica(docID, hedge=False):
+    if hedge: return getHedged(docID)
     try:
         result = collection.get(docID)
     except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError) as e:
@@ -51,6 +68,83 @@ def getNormalOrReplica(docID):
         raise e
     return result
 
+# --== Hedged reads ==--
+# Rather than waiting out the full KV timeout (~2.5s) before reading a replica,
+# fire the replica read once the primary is slower than HEDGE_PERCENTILE of
+# recent primary gets, and take whichever answer arrives first
+HEDGE_PERCENTILE = 95
+# Hedge delay (seconds) used until enough primary latencies have been seen
+HEDGE_DEFAULT_DELAY = 0.05
+HEDGE_MIN_SAMPLES = 20
+hedgeLatencies = deque(maxlen=1000)
+# calls: hedged reads made, fired: replica read was started,
+# primary/replica: which side answered, fallback: replica read after a primary error
+hedgeStats = {'calls': 0, 'fired': 0, 'primary': 0, 'replica': 0, 'fallback': 0}
+hedgeLock = threading.Lock()
+hedgePool = ThreadPoolExecutor(max_workers=16)
+replicaCollection = None
+
+# Replica reads get their own bucket handle so they aren't queued behind a slow primary read
+def getReplicaCollection():
+    global replicaCollection
+    with hedgeLock:
+        if replicaCollection is None:
+            replicaCollection = cluster.bucket('travel-sample').default_collection()
+    return replicaCollection
+
+def countHedge(stat):
+    with hedgeLock:
+        hedgeStats[stat] += 1
+
+def getHedgeStats():
+    with hedgeLock:
+        return dict(hedgeStats)
+
+# Seconds to wait on the primary before hedging
+def hedgeDelay(percentile=HEDGE_PERCENTILE):
+    with hedgeLock:
+        samples = sorted(hedgeLatencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return samples[min(len(samples)-1, int(len(samples) * percentile / 100))]
+
+def timedGet(docID):
+    start = time.perf_counter()
+    result = collection.get(docID)
+    with hedgeLock:
+        hedgeLatencies.append(time.perf_counter() - start)
+    return result
+
+def replicaGet(docID):
+    return getReplicaCollection().get(docID, replica=True)
+
+# Same as getNormalOrReplica, but hedges rather than waiting for a timeout.
+# The losing read can't be aborted once sent, so its result is ignored
+def getHedged(docID, percentile=HEDGE_PERCENTILE):
+    countHedge('calls')
+    primary = hedgePool.submit(timedGet, docID)
+    done, _ = wait([primary], timeout=hedgeDelay(percentile))
+    if done:
+        try:
+            result = primary.result()
+        except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError) as e:
+            countHedge('fallback')
+            return replicaGet(docID)
+        countHedge('primary')
+        return result
+    countHedge('fired')
+    replica = hedgePool.submit(replicaGet, docID)
+    pending = {primary, replica}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                for other in pending: other.cancel()
+                countHedge('primary' if f is primary else 'replica')
+                return f.result()
+    # Both sides failed, report the primary's error
+    return primary.result()
+
 # Gets with retries if first attempt fails.
 # Backoff factor can somewhat mitigate overloading the server with too many Gets at once
 def getOrRetry(docID, retries=2, delay=1000, backoff_factor=1):
@@ -77,19 +171,16 @@ def getRetryThenReplica(docID):
 # In the event of an error, outcome is still unknown.
 # In this case, retrying the whole operation is valid
 def upsertAndCheck(docID, value):
-    try:
-        oldCAS = collection.get(docID).cas
-    except CBErr.NotFoundError:
-        oldCAS = False
     try:
         collection.upsert(docID, value)
         return True
     except (CBErr.TimeoutError, CBErr.CouchbaseNetworkError ,CBErr.TemporaryFailError):
         try:
             res = getOrRetry(docID, 4, 1000)
-            # If there's no oldCAS and we got the document (ie: no error), insert successful
-            # otherwise, an increased CAS value means the operation was performed
-            return (not oldCAS) or (res.cas != oldCAS)
+            # Only read the document back when the outcome is unknown (no pre-read on the happy path).
+            # If it now holds our value the upsert was applied - or an identical write got there,
+            # which leaves the document in the same state
+            return res.content == value
         except RetriesExceededException:
             raise RetriesExceededException("Couldn't confirm or deny operation on key " + docID)
         except CBErr.NotFoundError:
@@ -133,15 +224,16 @@ def N1QLFetchAirports(search, field='airportname'):
     
 
 # Load a couple of docs and write them back
-for i in range(0,1):
-    keyname = "airline_1" + str(i)
-    doc = collection.get(keyname);
-    if doc and doc.content:
-        print(doc.content)
-        collection.upsert(keyname, doc.content);
+if __name__ == "__main__":
+    for i in range(0,1):
+        keyname = "airline_1" + str(i)
+        doc = collection.get(keyname);
+        if doc and doc.content:
+            print(doc.content)
+            collection.upsert(keyname, doc.content);
 
-# print(upsertAndCheck("test123",{'meme':'McMemerson'}))
+    # print(upsertAndCheck("test123",{'meme':'McMemerson'}))
 
-# print(getRetryThenReplica("test123").cas)
+    # print(getRetryThenReplica("test123").cas)
 
-print(N1QLFetchAirports("man"))
\ No newline at end of file
+    print(N1QLFetchAirports("man"))
\ No newline at end of file
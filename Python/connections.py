@@ -0,0 +1,206 @@
+import os, threading, itertools, time
+
+# Raised when an operation is attempted after close()
+class ConnectionsClosedException(Exception):
+    pass
+
+# Opens connections on first use rather than at import, and shares a bounded pool of them between threads.
+#   connections = ConnectionManager(openBucket, poolSize=4, disconnect=closeBucket, brokenOn=(CBErr.CouchbaseNetworkError,))
+#   bucket = connections.proxy()     # use like a bucket: each attribute lookup goes to one of the pooled handles
+#   b = connections.get()            # one handle, for several calls that must use the same connection
+# Slots are opened one at a time as requests reach them, so the first call waits for one connection, not all of them.
+# A handle that fails errorThreshold times in a row with one of brokenOn is reopened in the background,
+# the old one stays in use until the new one is ready (and is dropped once nothing is using it).
+# After a fork the child opens its own connections, the parent's are never used or closed by it
+class ConnectionManager:
+    def __init__(self, connect, poolSize=4, disconnect=None, brokenOn=(), errorThreshold=5, reconnectDelay=1, maxReconnectDelay=30):
+        self.connect = connect
+        self.poolSize = poolSize
+        self.disconnect = disconnect
+        self.brokenOn = tuple(brokenOn)
+        self.errorThreshold = errorThreshold
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.closed = False
+        # (select, name, value) set through a proxy, applied to every handle opened
+        self.options = []
+        self.stats = {'opened': 0, 'reconnects': 0, 'reconnectFailures': 0}
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+
+    # Forgets every connection (used after a fork, where they belong to the parent)
+    def reset(self):
+        self.pid = os.getpid()
+        self.handles = [None] * self.poolSize
+        self.slotLocks = [threading.Lock() for i in range(self.poolSize)]
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        # Connections opened with open(), outside the pool
+        self.extra = []
+        # slot -> consecutive brokenOn errors
+        self.errors = {}
+        self.broken = set()
+        self.reconnector = None
+        self.wake = threading.Event()
+        # id(handle) -> lock, see lockFor
+        self.handleLocks = {}
+
+    def get(self):
+        i = next(self.counter) % self.poolSize
+        handle = self.handles[i]
+        return handle if handle is not None else self.openSlot(i)
+
+    def openSlot(self, i):
+        with self.slotLocks[i]:
+            if self.closed: raise ConnectionsClosedException("Connections have been closed")
+            if self.handles[i] is None:
+                self.handles[i] = self.configure(self.connect())
+                with self.lock:
+                    self.stats['opened'] += 1
+            return self.handles[i]
+
+    # Opens every slot now, in parallel, rather than as requests reach them (e.g. to warm up before taking traffic)
+    def openAll(self):
+        def tryOpen(i):
+            try:
+                self.openSlot(i)
+            except Exception:
+                pass
+        threads = [threading.Thread(target=tryOpen, args=(i,)) for i in range(self.poolSize) if self.handles[i] is None]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        # Raises here if a slot couldn't be opened
+        return [self.handles[i] or self.openSlot(i) for i in range(self.poolSize)]
+
+    # A dedicated connection outside the pool (e.g. for a background monitor), closed with the rest
+    def open(self):
+        if self.closed: raise ConnectionsClosedException("Connections have been closed")
+        handle = self.configure(self.connect())
+        with self.lock:
+            self.extra.append(handle)
+            self.stats['opened'] += 1
+        return handle
+
+    def configure(self, handle):
+        for select, name, value in list(self.options):
+            setattr(select(handle) if select else handle, name, value)
+        return handle
+
+    def setOption(self, name, value, select=None):
+        with self.lock:
+            self.options = [o for o in self.options if o[:2] != (select, name)] + [(select, name, value)]
+            handles = [h for h in self.handles if h is not None] + self.extra
+        for h in handles:
+            with self.lockFor(h):
+                setattr(select(h) if select else h, name, value)
+
+    # Held by a caller that changes a per-handle setting (e.g. its timeout) for one call, and by
+    # the proxy around each call, so no other call on the handle runs under that setting.
+    # Handles opened with LOCKMODE_WAIT run one operation at a time anyway, so this costs no concurrency
+    def lockFor(self, handle):
+        lock = self.handleLocks.get(id(handle))
+        if lock is None:
+            with self.lock:
+                lock = self.handleLocks.setdefault(id(handle), threading.RLock())
+        return lock
+
+    def slotOf(self, handle):
+        for i, h in enumerate(self.handles):
+            if h is handle: return i
+        return None
+
+    def reportError(self, handle):
+        i = self.slotOf(handle)
+        if i is None: return
+        with self.lock:
+            self.errors[i] = self.errors.get(i, 0) + 1
+            if self.errors[i] < self.errorThreshold or i in self.broken or self.closed: return
+            self.broken.add(i)
+            if self.reconnector is None:
+                self.reconnector = threading.Thread(target=self.reconnectLoop, name='Reconnector', daemon=True)
+                self.reconnector.start()
+        self.wake.set()
+
+    def reportSuccess(self, handle):
+        if self.errors:
+            i = self.slotOf(handle)
+            with self.lock:
+                self.errors.pop(i, None)
+
+    def reconnectLoop(self):
+        delay = self.reconnectDelay
+        while not self.closed:
+            self.wake.wait()
+            with self.lock:
+                slots = list(self.broken)
+                if not slots: self.wake.clear()
+            for i in slots:
+                try:
+                    handle = self.configure(self.connect())
+                except Exception:
+                    with self.lock:
+                        self.stats['reconnectFailures'] += 1
+                    continue
+                with self.slotLocks[i]:
+                    # The old handle isn't closed here: calls may still be running on it
+                    self.handles[i] = handle
+                with self.lock:
+                    self.broken.discard(i)
+                    self.errors.pop(i, None)
+                    self.stats['reconnects'] += 1
+            with self.lock:
+                failed = bool(self.broken)
+            if failed:
+                time.sleep(delay)
+                delay = min(self.maxReconnectDelay, delay * 2)
+            else:
+                delay = self.reconnectDelay
+
+    # Stands in for a handle: attribute lookups go to a pooled handle (select(handle) if given,
+    # e.g. lambda c: c.collection). Setting an attribute sets it on every handle, open now or later
+    def proxy(self, select=None):
+        return PooledProxy(self, select)
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            handles = [h for h in self.handles if h is not None] + self.extra
+            self.handles = [None] * self.poolSize
+            self.extra = []
+        self.wake.set()
+        if self.pid != os.getpid() or self.disconnect is None: return
+        for h in handles:
+            try:
+                self.disconnect(h)
+            except Exception:
+                pass
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, open=sum(h is not None for h in self.handles), extra=len(self.extra), broken=len(self.broken))
+
+class PooledProxy:
+    def __init__(self, manager, select=None):
+        object.__setattr__(self, 'manager', manager)
+        object.__setattr__(self, 'select', select)
+
+    def __getattr__(self, name):
+        manager = self.manager
+        handle = manager.get()
+        attr = getattr(self.select(handle) if self.select else handle, name)
+        if not callable(attr): return attr
+        lock = manager.lockFor(handle)
+        def call(*args, **kwargs):
+            try:
+                with lock:
+                    result = attr(*args, **kwargs)
+            except manager.brokenOn:
+                manager.reportError(handle)
+                raise
+            manager.reportSuccess(handle)
+            return result
+        return call
+
+    def __setattr__(self, name, value):
+        self.manager.setOption(name, value, self.select)
@@ -0,0 +1,92 @@
+# Declarative handling of errors: what to do about each kind of error is a table, not an except chain.
+#   policy = ErrorPolicy().on((CBErr.TimeoutError, CBErr.CouchbaseNetworkError), Action(REPLICA, reportNode=True))
+#   try: ...
+#   except CBErr.CouchbaseError as e:
+#       action = policy.actionFor(e)
+#       if action.kind != REPLICA: raise
+# Rules are checked in the order they were added, like except clauses, and the first match wins.
+# A rule can also require attributes, e.g. .on(CBErr.CouchbaseError, action, is_transient=True).
+# The answer is worked out once per exception class and kept, so during an outage each error costs
+# a dictionary lookup. For that reason attributes are read once per class (on an instance made without
+# calling __init__), so only use ones that depend on the class alone, like is_transient
+
+# What to do about an error
+RETRY, REPLICA, VERIFY, FAIL_FAST = 'retry', 'replica', 'verify', 'failFast'
+
+class Action:
+    __slots__ = ('kind', 'retries', 'delay', 'backoffFactor', 'maxDelay', 'reportNode')
+
+    # retries, delay (ms), backoffFactor and maxDelay (ms) are how a retry (or a verifying read) is paced.
+    # reportNode: the error counts against the node's health
+    def __init__(self, kind, retries=0, delay=0, backoffFactor=1, maxDelay=None, reportNode=False):
+        self.kind = kind
+        self.retries = retries
+        self.delay = delay
+        self.backoffFactor = backoffFactor
+        self.maxDelay = maxDelay
+        self.reportNode = reportNode
+
+    # Milliseconds to wait after failed attempt number attempt (from 1). delay and backoffFactor override the action's
+    def backoff(self, attempt, delay=None, backoffFactor=None):
+        ms = (self.delay if delay is None else delay) * (self.backoffFactor if backoffFactor is None else backoffFactor) ** (attempt - 1)
+        return ms if self.maxDelay is None else min(ms, self.maxDelay)
+
+    def __repr__(self):
+        return 'Action({0}, retries={1}, delay={2}, backoffFactor={3}, maxDelay={4}, reportNode={5})'.format(
+            self.kind, self.retries, self.delay, self.backoffFactor, self.maxDelay, self.reportNode)
+
+FAIL = Action(FAIL_FAST)
+
+class ErrorPolicy:
+    def __init__(self, default=FAIL):
+        self.default = default
+        # (classes, {attribute: value}, action)
+        self.rules = []
+        # exception class -> Action, and error code -> Action for batch results
+        self.byType = {}
+        self.byRC = {}
+
+    def on(self, types, action, **attrs):
+        self.rules.append((types, attrs, action))
+        self.byType = {}
+        self.byRC = {}
+        return self
+
+    def actionFor(self, err):
+        action = self.byType.get(type(err))
+        return action if action is not None else self.resolve(type(err))
+
+    # For batch results, which carry an error code (result.rc) rather than an exception
+    def actionForRC(self, rc, toType):
+        action = self.byRC.get(rc)
+        if action is None:
+            action = self.byRC[rc] = self.resolve(toType(rc))
+        return action
+
+    def resolve(self, cls):
+        action = self.default
+        for types, attrs, a in self.rules:
+            if issubclass(cls, types) and all(classAttr(cls, k) == v for k, v in attrs.items()):
+                action = a
+                break
+        self.byType[cls] = action
+        return action
+
+    # Fills the table up front, e.g. with every class the SDK has
+    def precompute(self, classes):
+        for cls in classes:
+            self.resolve(cls)
+        return self
+
+def classAttr(cls, name):
+    v = getattr(cls, name, None)
+    if not isinstance(v, property): return v
+    try:
+        return v.fget(cls.__new__(cls))
+    except Exception:
+        return None
+
+# Short description of an error from its class and error code, rather than by picking its message apart
+def describe(err):
+    rc = getattr(err, 'rc', 0)
+    return type(err).__name__ + (' (rc=0x{0:02X})'.format(rc) if rc else '')
@@ -0,0 +1,276 @@
+import random, time, threading, re, zlib
+import couchbase.cluster
+import couchbase.exceptions as CBErr
+from couchbase.n1ql import N1QLError
+
+# In-process stand-in for a travel-sample bucket, for running the helpers offline (see benchmark.py)
+# Each KV node has its own latency distribution and fault rates. Keys map to nodes through a
+# vbucket map like the real client's, with the replica on the next node along.
+#
+#   bucket = FakeBucket([FakeNode('node1'), FakeNode('node2', timeoutRate=0.05)], timeout=0.1)
+#   bucket.loadSampleData()
+#   install(bucket)   # Cluster(...).open_bucket(...) now returns a connection to bucket
+#   import clean
+
+# libcouchbase error codes
+TMPFAIL, KEY_EEXISTS, NOT_FOUND, NETWORK_ERROR, TIMEOUT = 0x0B, 0x0C, 0x0D, 0x10, 0x17
+
+def cbError(rc, message, **params):
+    return CBErr.CouchbaseError.rc_to_exctype(rc)(dict(params, rc=rc, message=message))
+
+# Latencies are lognormal around medianMs. A down node times out on every operation
+class FakeNode:
+    def __init__(self, host, medianMs=0.5, sigma=0.5, timeoutRate=0, networkErrorRate=0, tempFailRate=0, down=False):
+        self.host = host
+        self.medianMs = medianMs
+        self.sigma = sigma
+        self.timeoutRate = timeoutRate
+        self.networkErrorRate = networkErrorRate
+        self.tempFailRate = tempFailRate
+        self.down = down
+
+    def latency(self):
+        return self.medianMs / 1000 * random.lognormvariate(0, self.sigma)
+
+    def outcome(self):
+        if self.down: return TIMEOUT
+        r = random.random()
+        if r < self.timeoutRate: return TIMEOUT
+        r -= self.timeoutRate
+        if r < self.networkErrorRate: return NETWORK_ERROR
+        r -= self.networkErrorRate
+        if r < self.tempFailRate: return TMPFAIL
+        return 0
+
+class FakeResult:
+    def __init__(self, key, value=None, cas=0, rc=0):
+        self.key = key
+        self.value = value
+        self.cas = cas
+        self.rc = rc
+
+    @property
+    def success(self):
+        return self.rc == 0
+
+    def __repr__(self):
+        return 'FakeResult(key={0!r}, rc={1}, cas={2}, value={3!r})'.format(self.key, self.rc, self.cas, self.value)
+
+class FakeBucket:
+    def __init__(self, nodes=None, timeout=2.5, queryMs=5, n1qlErrorRate=0, vbuckets=1024):
+        self.docs = {}
+        self.prepared = {}
+        self.lock = threading.Lock()
+        self.nextCAS = 1
+        self.vbuckets = vbuckets
+        self.configure(nodes or [FakeNode('127.0.0.' + str(i)) for i in range(1, 4)], timeout, queryMs, n1qlErrorRate)
+
+    # Change the fault scenario in place, keeping the data.
+    # slowQueryRate of the full airport queries take slowQueryMs instead of queryMs (e.g. a struggling index)
+    def configure(self, nodes, timeout=2.5, queryMs=5, n1qlErrorRate=0, slowQueryRate=0, slowQueryMs=0):
+        self.nodes = nodes
+        self.timeout = timeout
+        self.queryMs = queryMs
+        self.n1qlErrorRate = n1qlErrorRate
+        self.slowQueryRate = slowQueryRate
+        self.slowQueryMs = slowQueryMs
+        self.server_nodes = [n.host + ':11210' for n in nodes]
+
+    def loadSampleData(self, airports=2000, airlines=200, seed=1):
+        rng = random.Random(seed)
+        syllables = ['man', 'ard', 'ber', 'lin', 'ton', 'ville', 'port', 'int', 'el', 'san', 'ro', 'ka', 'mo', 'dor', 'ia']
+        name = lambda n: ''.join(rng.choice(syllables) for _ in range(n)).title()
+        for i in range(airports):
+            city = name(2)
+            self.store('airport_' + str(i), {'type': 'airport', 'id': i, 'airportname': city + ' ' + name(2) + ' Airport',
+                                            'city': city, 'country': name(3), 'faa': name(1)[:3].upper(),
+                                            'geo': {'lat': rng.uniform(-90, 90), 'lon': rng.uniform(-180, 180), 'alt': rng.randint(0, 3000)}})
+        for i in range(airlines):
+            self.store('airline_' + str(i), {'type': 'airline', 'id': i, 'name': name(2) + ' Air', 'callsign': name(2).upper(),
+                                            'country': name(3), 'iata': name(1)[:2].upper()})
+
+    def store(self, key, value):
+        with self.lock:
+            self.nextCAS += 1
+            self.docs[key] = (value, self.nextCAS)
+
+    def _vbmap(self, key):
+        vbucket = zlib.crc32(key.encode()) % self.vbuckets
+        return vbucket, vbucket % len(self.nodes)
+
+    def nodeFor(self, key, replica=False):
+        index = self._vbmap(key)[1]
+        return self.nodes[(index + 1) % len(self.nodes) if replica else index]
+
+    # Outcome and latency for one operation on key. Anything slower than the timeout times out
+    def attempt(self, key, replica=False, timeout=None):
+        timeout = timeout or self.timeout
+        rc = self.nodeFor(key, replica).outcome()
+        latency = self.nodeFor(key, replica).latency()
+        if rc == TIMEOUT or latency > timeout:
+            return TIMEOUT, timeout
+        return rc, latency
+
+    def read(self, key, rc):
+        if rc: return FakeResult(key, rc=rc)
+        with self.lock:
+            doc = self.docs.get(key)
+        return FakeResult(key, doc[0], doc[1]) if doc else FakeResult(key, rc=NOT_FOUND)
+
+    # Timeouts and network errors are ambiguous: the write lands half the time
+    def write(self, key, value, rc):
+        if rc == 0 or (rc in (TIMEOUT, NETWORK_ERROR) and random.random() < 0.5):
+            self.store(key, value)
+        with self.lock:
+            cas = self.docs[key][1] if key in self.docs else 0
+        return FakeResult(key, cas=cas, rc=rc)
+
+    # timeout is the connection's (see FakeConnection), the bucket's by default
+    def get(self, key, replica=False, timeout=None, **kwargs):
+        rc, delay = self.attempt(key, replica, timeout)
+        time.sleep(delay)
+        result = self.read(key, rc)
+        if result.rc: raise cbError(result.rc, 'get ' + key, key=key)
+        return result
+
+    def upsert(self, key, value, timeout=None, **kwargs):
+        rc, delay = self.attempt(key, timeout=timeout)
+        time.sleep(delay)
+        result = self.write(key, value, rc)
+        if result.rc: raise cbError(result.rc, 'upsert ' + key, key=key)
+        return result
+
+    # Fails with KEY_EEXISTS if cas is given and the document's has changed
+    def replace(self, key, value, cas=0, timeout=None, **kwargs):
+        rc, delay = self.attempt(key, timeout=timeout)
+        time.sleep(delay)
+        if rc == 0:
+            with self.lock:
+                if key not in self.docs: rc = NOT_FOUND
+                elif cas and self.docs[key][1] != cas: rc = KEY_EEXISTS
+        result = self.write(key, value, rc)
+        if result.rc: raise cbError(result.rc, 'replace ' + key, key=key)
+        return result
+
+    # Fails with KEY_EEXISTS if the document exists
+    def insert(self, key, value, timeout=None, **kwargs):
+        rc, delay = self.attempt(key, timeout=timeout)
+        time.sleep(delay)
+        if rc == 0:
+            with self.lock:
+                if key in self.docs: rc = KEY_EEXISTS
+        result = self.write(key, value, rc)
+        if result.rc: raise cbError(result.rc, 'insert ' + key, key=key)
+        return result
+
+    # Operations are pipelined: the batch takes as long as its slowest key
+    def multi(self, keys, op, replica=False, timeout=None):
+        attempts = {k: self.attempt(k, replica, timeout) for k in keys}
+        time.sleep(max([delay for rc, delay in attempts.values()] or [0]))
+        results = {k: op(k, rc) for k, (rc, delay) in attempts.items()}
+        failed = [r for r in results.values() if r.rc]
+        if failed: raise cbError(failed[0].rc, 'multi operation failed', all_results=results, key=failed[0].key)
+        return results
+
+    def get_multi(self, keys, replica=False, timeout=None, **kwargs):
+        return self.multi(keys, self.read, replica, timeout)
+
+    def upsert_multi(self, items, timeout=None, **kwargs):
+        return self.multi(list(items), lambda k, rc: self.write(k, items[k], rc), timeout=timeout)
+
+    def ping(self):
+        return {'kv': [{'server': n.host + ':11210', 'status': 1 if n.down else 0, 'latency_us': int(n.latency() * 1e6)} for n in self.nodes]}
+
+    def n1ql_query(self, q):
+        return FakeQuery(self, q._body['statement'], q._body.get('args', []))
+
+    # Understands the airport search statements used by the helpers, plain, paginated and prepared
+    def runQuery(self, statement, args):
+        slow = 'airportname, city' in statement and random.random() < self.slowQueryRate
+        time.sleep((self.slowQueryMs if slow else self.queryMs) / 1000)
+        prepare = re.match(r"PREPARE `(\w+)` FROM (.*)", statement, re.S)
+        if prepare:
+            self.prepared[prepare.group(1)] = prepare.group(2)
+            return
+        execute = re.match(r"EXECUTE `(\w+)`", statement)
+        if execute:
+            if execute.group(1) not in self.prepared:
+                raise N1QLError({'message': 'No such prepared statement', 'objextra': {'code': 4040}})
+            statement = self.prepared[execute.group(1)]
+        # Airports changed since a CAS, as [id, airportname, cas]
+        if 'meta().cas' in statement:
+            with self.lock:
+                rows = [[k, v['airportname'], cas] for k, (v, cas) in sorted(self.docs.items()) if v.get('type') == 'airport' and cas > args[0]]
+            yield from rows
+            return
+        if 'airportname, city' in statement and random.random() < self.n1qlErrorRate:
+            raise N1QLError({'message': 'N1QL Execution failed', 'objextra': {'code': 12008, 'msg': 'Error performing bulk get operation'}})
+        search = args[0].strip('%').lower()
+        after = args[1] if len(args) > 1 else None
+        limit = re.search(r"LIMIT (\d+)", statement)
+        with self.lock:
+            ids = sorted(k for k, (v, cas) in self.docs.items()
+                         if v.get('type') == 'airport' and search in v['airportname'].lower() and (after is None or k > after))
+        if limit: ids = ids[:int(limit.group(1))]
+        for k in ids:
+            v = self.docs[k][0]
+            if 'RAW meta().id' in statement: yield k
+            elif 'AS id' in statement: yield {'id': k, 'airportname': v['airportname'], 'city': v['city']}
+            elif 'SELECT meta().id' in statement: yield {'id': k}
+            else: yield {'airportname': v['airportname'], 'city': v['city']}
+
+# Rows are only produced (and errors only raised) once iterated, like the SDK's N1QLRequest
+class FakeQuery:
+    def __init__(self, bucket, statement, args):
+        self.bucket = bucket
+        self.statement = statement
+        self.args = args
+
+    def __iter__(self):
+        return self.bucket.runQuery(self.statement, self.args)
+
+    def execute(self):
+        for row in self: pass
+        return self
+
+# One open_bucket() connection: like the SDK's, it has its own timeout (None: the bucket's),
+# everything else is the shared bucket
+class FakeConnection:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.timeout = None
+
+    def __getattr__(self, name):
+        return getattr(self.bucket, name)
+
+    def get(self, key, replica=False, **kwargs):
+        return self.bucket.get(key, replica, self.timeout)
+
+    def upsert(self, key, value, **kwargs):
+        return self.bucket.upsert(key, value, self.timeout)
+
+    def replace(self, key, value, cas=0, **kwargs):
+        return self.bucket.replace(key, value, cas, self.timeout)
+
+    def insert(self, key, value, **kwargs):
+        return self.bucket.insert(key, value, self.timeout)
+
+    def get_multi(self, keys, replica=False, **kwargs):
+        return self.bucket.get_multi(keys, replica, self.timeout)
+
+    def upsert_multi(self, items, **kwargs):
+        return self.bucket.upsert_multi(items, self.timeout)
+
+class FakeCluster:
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def authenticate(self, authenticator):
+        pass
+
+    def open_bucket(self, name, **kwargs):
+        return FakeConnection(self.bucket)
+
+# Makes couchbase.cluster.Cluster hand out connections to bucket. Call before importing the helpers
+def install(bucket):
+    couchbase.cluster.Cluster = lambda *args, **kwargs: FakeCluster(bucket)
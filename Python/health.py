@@ -0,0 +1,136 @@
+import threading, time
+
+# Circuit breaker states
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Raised instead of sending a write to a node whose breaker is open
+class NodeUnavailableException(Exception):
+    pass
+
+# Per-node circuit breaker.
+# Opens after failureThreshold consecutive failures (failed pings or KV timeouts/network errors,
+# any success in between starts the count again), goes half-open after resetTimeout seconds,
+# and the next success/failure closes/re-opens it. While half-open allowRequest() lets one
+# request through as a trial (another every resetTimeout, in case one never reports back)
+class CircuitBreaker:
+    def __init__(self, failureThreshold=3, resetTimeout=5):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = 0
+        self.lock = threading.Lock()
+
+    def getState(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.openedAt >= self.resetTimeout:
+                self.state = HALF_OPEN
+            return self.state
+
+    def isOpen(self):
+        return self.getState() == OPEN
+
+    # For the request path: whether to send a request to the node
+    def allowRequest(self):
+        if self.state == CLOSED: return True
+        with self.lock:
+            if self.state == CLOSED: return True
+            now = time.monotonic()
+            if now - self.openedAt < self.resetTimeout: return False
+            self.state = HALF_OPEN
+            self.openedAt = now
+            return True
+
+    def recordSuccess(self):
+        # Every successful KV operation ends up here, don't take the lock when there's nothing to reset
+        if self.state == CLOSED and self.failures == 0: return
+        with self.lock:
+            self.failures = 0
+            self.state = CLOSED
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failureThreshold:
+                self.state = OPEN
+                self.openedAt = time.monotonic()
+
+# Pings the cluster every interval seconds on a background thread and keeps a breaker per KV node,
+# so the request path can check whether a node is up instead of waiting for a timeout.
+# Give it its own bucket handle: a ping to a dead node is slow and shouldn't hold up other operations
+class HealthMonitor:
+    def __init__(self, bucket, interval=1, failureThreshold=3, resetTimeout=5):
+        self.bucket = bucket
+        self.interval = interval
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='HealthMonitor', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread: self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.pingOnce()
+            except Exception:
+                # A ping that fails outright says nothing about individual nodes,
+                # KV errors reported by the helpers still drive the breakers
+                pass
+            self.stopped.wait(self.interval)
+
+    def pingOnce(self):
+        for x in self.bucket.ping()['kv']:
+            # A status of 0 means the node answered
+            self.recordResult(x['server'].split(':')[0], x['status'] == 0)
+
+    def getBreaker(self, node):
+        breaker = self.breakers.get(node)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(node, CircuitBreaker(self.failureThreshold, self.resetTimeout))
+        return breaker
+
+    def recordResult(self, node, ok):
+        breaker = self.getBreaker(node)
+        if ok: breaker.recordSuccess()
+        else: breaker.recordFailure()
+
+    # Node holding the active copy of key, from the client's own vbucket map (no network access)
+    def nodeForKey(self, key):
+        vbucket, index = self.bucket._vbmap(key)
+        return self.bucket.server_nodes[index].split(':')[0]
+
+    # For the request path: True to keep a request away from node. A half-open node takes one trial request
+    def isOpen(self, node):
+        breaker = self.breakers.get(node)
+        return breaker is not None and not breaker.allowRequest()
+
+    def keyIsOpen(self, key):
+        return self.isOpen(self.nodeForKey(key))
+
+    # Whether key's node is open, without taking the trial request
+    def keyIsDown(self, key):
+        breaker = self.breakers.get(self.nodeForKey(key))
+        return breaker is not None and breaker.isOpen()
+
+    def getStates(self):
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {node: b.getState() for node, b in breakers.items()}
+
+    def getNodes(self):
+        return [node for node, state in self.getStates().items() if state != OPEN]
+
+    def getDownNodes(self):
+        return [node for node, state in self.getStates().items() if state == OPEN]
@@ -0,0 +1,227 @@
+import mmap, os, struct, threading, time, json, zlib, hashlib
+
+# Append-only local journal of writes whose outcome is unknown (the upsert timed out and nobody
+# has checked yet), so the caller can carry on and the check happens later, even after a restart.
+#   journal = Journal('upserts.journal')
+#   entry = journal.append(key, value, preCAS)
+#   ...
+#   journal.resolve(entry)
+# The file is memory mapped and grown in chunks. Each record is a fixed header
+# (length, crc32, kind, timestamp, pre-write CAS, ref, value hash, key/value lengths) then the key and
+# the value (as JSON, it's needed to write it again). Resolving an entry appends a small resolved
+# record rather than rewriting anything, and compact() rewrites the file with only the open entries.
+# On open the records are replayed; a torn or corrupt tail (a crash mid-append) is cut off there.
+# Appends land in the page cache straight away, so they survive the process dying; sync=True also
+# flushes every append to disk, so they survive the machine dying too (at ~ms per append)
+
+MAGIC = b'CBJRNL01'
+RECORD = struct.Struct('<IIBdQQ16sHI')
+ENTRY, RESOLVED = 1, 2
+
+def encodeValue(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+
+# Hash of a value as it would be written, used to tell whether the document holds it
+def valueHash(value):
+    return hashlib.blake2b(encodeValue(value), digest_size=16).digest()
+
+class Entry:
+    __slots__ = ('key', 'value', 'valueHash', 'preCAS', 'timestamp', 'offset')
+
+    def __init__(self, key, value, valueHash, preCAS, timestamp, offset):
+        self.key = key
+        self.value = value
+        self.valueHash = valueHash
+        self.preCAS = preCAS
+        self.timestamp = timestamp
+        self.offset = offset
+
+class Journal:
+    def __init__(self, path, chunkSize=1 << 20, sync=False):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.sync = sync
+        self.lock = threading.Lock()
+        # key -> latest open Entry. A newer write to a key replaces the older one: only the last value matters
+        self.pending = {}
+        self.resolvedRecords = 0
+        self.open()
+
+    def open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) < len(MAGIC)
+        self.file = open(self.path, 'r+b' if not new else 'w+b')
+        if new:
+            self.file.write(MAGIC)
+            self.file.truncate(self.chunkSize)
+            self.file.flush()
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(self.path + " is not an upsert journal")
+        self.end = self.replay()
+
+    # Rebuilds the open entries from the records, returns where the next record goes
+    def replay(self):
+        self.pending = {}
+        self.resolvedRecords = 0
+        byOffset = {}
+        pos = len(MAGIC)
+        size = len(self.mm)
+        while pos + RECORD.size <= size:
+            length, crc, kind, timestamp, preCAS, ref, digest, keyLen, valueLen = RECORD.unpack_from(self.mm, pos)
+            if length == 0: break
+            if length != RECORD.size + keyLen + valueLen or pos + length > size or zlib.crc32(self.mm[pos+8:pos+length]) != crc:
+                # Torn write, everything from here on is discarded
+                self.mm[pos:size] = bytes(size - pos)
+                break
+            key = self.mm[pos+RECORD.size:pos+RECORD.size+keyLen].decode()
+            if kind == ENTRY:
+                value = json.loads(self.mm[pos+RECORD.size+keyLen:pos+length])
+                entry = byOffset[pos] = Entry(key, value, digest, preCAS, timestamp, pos)
+                self.pending[key] = entry
+            elif kind == RESOLVED:
+                self.resolvedRecords += 1
+                entry = byOffset.get(ref)
+                if entry is not None and self.pending.get(key) is entry:
+                    del self.pending[key]
+            pos += length
+        return pos
+
+    def write(self, kind, key, preCAS=0, ref=0, digest=bytes(16), valueBytes=b'', timestamp=None):
+        keyBytes = key.encode()
+        length = RECORD.size + len(keyBytes) + len(valueBytes)
+        if self.end + length > len(self.mm): self.grow(length)
+        body = RECORD.pack(length, 0, kind, timestamp or time.time(), preCAS, ref, digest, len(keyBytes), len(valueBytes))[8:] + keyBytes + valueBytes
+        pos = self.end
+        self.mm[pos:pos+length] = struct.pack('<II', length, zlib.crc32(body)) + body
+        self.end += length
+        if self.sync: self.mm.flush()
+        return pos
+
+    def grow(self, needed):
+        size = len(self.mm) + max(self.chunkSize, needed)
+        self.mm.close()
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    # Journals a write of value to key. preCAS is the CAS the document had before (0 if not known)
+    def append(self, key, value, preCAS=0):
+        valueBytes = encodeValue(value)
+        digest = hashlib.blake2b(valueBytes, digest_size=16).digest()
+        with self.lock:
+            now = time.time()
+            offset = self.write(ENTRY, key, preCAS, 0, digest, valueBytes, now)
+            entry = self.pending[key] = Entry(key, value, digest, preCAS, now, offset)
+        return entry
+
+    # Marks an entry as dealt with. Returns False if a newer write to the key has been journaled since
+    def resolve(self, entry):
+        with self.lock:
+            if self.pending.get(entry.key) is not entry: return False
+            del self.pending[entry.key]
+            self.write(RESOLVED, entry.key, ref=entry.offset)
+            self.resolvedRecords += 1
+            return True
+
+    # Open entries, oldest first
+    def openEntries(self, limit=None):
+        with self.lock:
+            entries = sorted(self.pending.values(), key=lambda e: e.offset)
+        return entries[:limit] if limit else entries
+
+    # Rewrites the journal with only the open entries (to a new file, then renamed over the old one)
+    def compact(self):
+        with self.lock:
+            tmp = self.path + '.compact'
+            entries = sorted(self.pending.values(), key=lambda e: e.offset)
+            with open(tmp, 'wb') as f:
+                pos = len(MAGIC)
+                f.write(MAGIC)
+                for e in entries:
+                    keyBytes, valueBytes = e.key.encode(), encodeValue(e.value)
+                    length = RECORD.size + len(keyBytes) + len(valueBytes)
+                    body = RECORD.pack(length, 0, ENTRY, e.timestamp, e.preCAS, 0, e.valueHash, len(keyBytes), len(valueBytes))[8:] + keyBytes + valueBytes
+                    f.write(struct.pack('<II', length, zlib.crc32(body)) + body)
+                    e.offset = pos
+                    pos += length
+                f.truncate(max(self.chunkSize, pos))
+                f.flush()
+                os.fsync(f.fileno())
+            self.mm.close()
+            self.file.close()
+            os.replace(tmp, self.path)
+            self.file = open(self.path, 'r+b')
+            self.mm = mmap.mmap(self.file.fileno(), 0)
+            self.end = pos
+            self.resolvedRecords = 0
+
+    def flush(self):
+        with self.lock:
+            self.mm.flush()
+
+    def close(self):
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+
+    def getStats(self):
+        with self.lock:
+            return {'open': len(self.pending), 'resolvedRecords': self.resolvedRecords, 'bytes': self.end}
+
+# Works through the journal in the background: every interval seconds the oldest batchSize open
+# entries are handed to resolveBatch(entries) -> {entry: outcome}. Entries it returns an outcome for
+# are resolved; the rest (e.g. the check timed out again) stay for the next pass.
+# An outcome in failedOutcomes is also passed to onFailure(key, value, outcome).
+# Once more than compactAfter resolved records have piled up the journal is compacted
+class Reconciler:
+    def __init__(self, journal, resolveBatch, interval=1, batchSize=500, compactAfter=10000,
+                 onFailure=None, failedOutcomes=()):
+        self.journal = journal
+        self.resolveBatch = resolveBatch
+        self.interval = interval
+        self.batchSize = batchSize
+        self.compactAfter = compactAfter
+        self.onFailure = onFailure
+        self.failedOutcomes = failedOutcomes
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {'passes': 0, 'checked': 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='JournalReconciler', daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.runOnce()
+            except Exception:
+                # e.g. the cluster is unreachable, try again next pass
+                pass
+
+    # One pass. Returns how many entries were resolved
+    def runOnce(self):
+        entries = self.journal.openEntries(self.batchSize)
+        resolved = 0
+        if entries:
+            outcomes = self.resolveBatch(entries)
+            self.stats['passes'] += 1
+            self.stats['checked'] += len(entries)
+            for entry, outcome in outcomes.items():
+                if not self.journal.resolve(entry): continue
+                resolved += 1
+                self.stats[outcome] = self.stats.get(outcome, 0) + 1
+                if outcome in self.failedOutcomes and self.onFailure:
+                    self.onFailure(entry.key, entry.value, outcome)
+        if self.journal.resolvedRecords > self.compactAfter:
+            self.journal.compact()
+        return resolved
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread is not None: self.thread.join(timeout)
+        self.journal.flush()
+
+    def getStats(self):
+        return dict(self.stats, **self.journal.getStats())
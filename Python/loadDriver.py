@@ -0,0 +1,94 @@
+from couchbase.cluster import Cluster
+from couchbase.cluster import PasswordAuthenticator
+import couchbase.exceptions as CBErr
+from multiprocessing import Pool
+from logStats import bucketFor, quantile
+import argparse, time
+
+# Multi-process version of the get -> upsert loop in clean.py / tracing.py.
+# Each worker process opens its own connection and works on its own share of the keys.
+# With --rate the operations are sent on a fixed schedule (open loop) and latency is measured
+# from when each operation was due, not when it was actually sent, so a stalled server
+# shows up as latency rather than as fewer requests (coordinated omission).
+# e.g. python3 loadDriver.py --workers 8 --rate 20000 --ops 200000
+#      python3 loadDriver.py --fake     (against fakeBucket, no cluster needed)
+
+CONN_STR = 'couchbase://10.143.191.101,10.143.191.102,10.143.191.103'
+USERNAME = 'Danzibob'
+PASSWORD = 'C0uchbase123'
+
+def connect(fake, thresholdUs):
+    if fake:
+        from fakeBucket import FakeBucket
+        bucket = FakeBucket()
+        bucket.loadSampleData()
+        return bucket
+    cluster = Cluster(CONN_STR)
+    cluster.authenticate(PasswordAuthenticator(USERNAME, PASSWORD))
+    bucket = cluster.open_bucket('travel-sample')
+    if thresholdUs:
+        bucket.tracing_threshold_kv = thresholdUs
+    return bucket
+
+# Read a doc and write it back, as the sample loop does
+def readModifyWrite(bucket, key):
+    doc = bucket.get(key)
+    if doc and doc.value:
+        bucket.upsert(key, doc.value)
+
+# Runs ops operations over keys at rate ops/sec (0 = as fast as possible)
+# Returns a latency histogram in microseconds (see logStats.bucketFor) plus counts
+def worker(keys, ops, rate, fake, thresholdUs):
+    bucket = connect(fake, thresholdUs)
+    hist = {}
+    errors = 0
+    maximum = 0
+    start = time.perf_counter()
+    for i in range(ops):
+        due = start + i / rate if rate else time.perf_counter()
+        wait = due - time.perf_counter()
+        if wait > 0: time.sleep(wait)
+        try:
+            readModifyWrite(bucket, keys[i % len(keys)])
+        except CBErr.CouchbaseError:
+            errors += 1
+        us = (time.perf_counter() - due) * 1000000
+        maximum = max(maximum, us)
+        b = bucketFor(us)
+        hist[b] = hist.get(b, 0) + 1
+    return {'ops': ops, 'errors': errors, 'seconds': time.perf_counter() - start, 'hist': hist, 'max': maximum}
+
+def merge(results):
+    hist = {}
+    for r in results:
+        for b, n in r['hist'].items():
+            hist[b] = hist.get(b, 0) + n
+    return hist
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel read-modify-write load driver")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=10000, help="total operations across all workers")
+    parser.add_argument('--rate', type=float, default=0, help="target total ops/sec (0 = unpaced)")
+    parser.add_argument('--keys', type=int, default=10, help="number of airline_1x style keys")
+    parser.add_argument('--threshold-us', type=int, default=0, help="tracing_threshold_kv for each worker's bucket")
+    parser.add_argument('--fake', action='store_true', help="use fakeBucket instead of a cluster")
+    args = parser.parse_args()
+
+    keys = ["airline_1" + str(i) for i in range(args.keys)]
+    # Shard the key space so workers don't contend on the same documents
+    shards = [keys[w::args.workers] or keys for w in range(args.workers)]
+    perWorker = args.ops // args.workers
+    with Pool(args.workers) as pool:
+        results = pool.starmap(worker, [(shard, perWorker, args.rate / args.workers, args.fake, args.threshold_us) for shard in shards])
+
+    hist = merge(results)
+    ops = sum(r['ops'] for r in results)
+    seconds = max(r['seconds'] for r in results)
+    maximum = max(r['max'] for r in results)
+    print("workers={0} ops={1} errors={2} ops/s={3:.0f}".format(args.workers, ops, sum(r['errors'] for r in results), ops / seconds))
+    print("latency ms: p50={0:.3f} p99={1:.3f} p99.9={2:.3f} max={3:.3f}".format(
+        *(quantile(hist, ops, q, maximum) / 1000 for q in (0.5, 0.99, 0.999)), maximum / 1000))
+
+if __name__ == "__main__":
+    main()
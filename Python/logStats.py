@@ -0,0 +1,127 @@
+import logging, json, math, threading, time
+
+# Aggregates libcouchbase's threshold logging reports as they are logged, e.g.
+#   Orphan responses observed: {"count":2,"service":"kv","top":[{"last_operation_id":"get:0x2f","last_remote_address":"10.143.191.102:11210","server_us":0,"total_us":3528275}, ...]}
+#   Operations over threshold: {"count":5,"service":"kv","top":[{"operation_name":"get", ...}]}
+# into per node/operation latency histograms and orphan counts over a sliding window.
+# Only the parsed numbers are kept, never the log lines themselves.
+#
+# As a logging handler:
+#   stats = ThresholdLogStats()
+#   logging.getLogger().addHandler(stats)
+#   ...
+#   print(stats.snapshot())
+# or on an existing log file:
+#   for line in open('app.log'): stats.feedLine(line)
+
+REPORTS = {'Orphan responses observed': 'orphan', 'Operations over threshold': 'slow'}
+
+# Latency histogram buckets: 4 per power of 2 (each bucket is ~19% wide).
+# The histogram helpers take the resolution, so finer histograms (e.g. metrics.py's) share them
+BUCKETS_PER_OCTAVE = 4
+
+def bucketFor(us, perOctave=BUCKETS_PER_OCTAVE):
+    return int(math.log2(us) * perOctave) if us >= 1 else 0
+
+def bucketUpper(index, perOctave=BUCKETS_PER_OCTAVE):
+    return 2 ** ((index + 1) / perOctave)
+
+class ThresholdLogStats(logging.Handler):
+    # Keeps windowSeconds of data in slices of windowSeconds/slices seconds
+    def __init__(self, windowSeconds=60, slices=6, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.sliceSeconds = windowSeconds / slices
+        self.slices = [None] * slices
+        self.statsLock = threading.Lock()
+        self.malformed = 0
+
+    def emit(self, record):
+        try:
+            self.feedLine(record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+    def feedLine(self, line, now=None):
+        for prefix, kind in REPORTS.items():
+            if prefix in line: break
+        else:
+            return
+        try:
+            report = json.loads(line[line.index('{'):line.rindex('}') + 1])
+        except ValueError:
+            self.malformed += 1
+            return
+        self.addReport(kind, report, now)
+
+    def currentSlice(self, now):
+        epoch = int(now / self.sliceSeconds)
+        i = epoch % len(self.slices)
+        if self.slices[i] is None or self.slices[i]['epoch'] != epoch:
+            self.slices[i] = {'epoch': epoch, 'ops': {}, 'orphans': {}, 'orphanTotal': 0}
+        return self.slices[i]
+
+    def addReport(self, kind, report, now=None):
+        now = time.time() if now is None else now
+        service = report.get('service', '?')
+        with self.statsLock:
+            current = self.currentSlice(now)
+            for op in report.get('top', []):
+                node = op.get('last_remote_address', '?').rsplit(':', 1)[0]
+                name = op.get('operation_name') or op.get('last_operation_id', '?').split(':')[0]
+                key = (kind, service, node, name)
+                stat = current['ops'].get(key)
+                if stat is None:
+                    stat = current['ops'][key] = {'count': 0, 'max': 0, 'hist': {}}
+                total = op.get('total_us', 0)
+                stat['count'] += 1
+                stat['max'] = max(stat['max'], total)
+                b = bucketFor(total)
+                stat['hist'][b] = stat['hist'].get(b, 0) + 1
+                if kind == 'orphan':
+                    current['orphans'][node] = current['orphans'].get(node, 0) + 1
+            if kind == 'orphan':
+                # Covers every orphan seen, not only the ones listed in top
+                current['orphanTotal'] += report.get('count', 0)
+
+    # Compact summary of the window:
+    # {'ops': {'slow kv 10.0.0.2 get': {'count', 'p50_us', 'p99_us', 'max_us'}}, 'orphans': {node: {'count', 'perSecond'}}, 'orphanTotal'}
+    # Per node orphan counts only include the orphans listed in each report's top entries
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        oldest = int(now / self.sliceSeconds) - len(self.slices) + 1
+        ops, orphans = {}, {}
+        orphanTotal = 0
+        with self.statsLock:
+            for s in self.slices:
+                if s is None or s['epoch'] < oldest: continue
+                for key, stat in s['ops'].items():
+                    merged = ops.setdefault(key, {'count': 0, 'max': 0, 'hist': {}})
+                    merged['count'] += stat['count']
+                    merged['max'] = max(merged['max'], stat['max'])
+                    for b, n in stat['hist'].items():
+                        merged['hist'][b] = merged['hist'].get(b, 0) + n
+                for node, n in s['orphans'].items():
+                    orphans[node] = orphans.get(node, 0) + n
+                orphanTotal += s['orphanTotal']
+        window = len(self.slices) * self.sliceSeconds
+        return {
+            'windowSeconds': window,
+            'ops': {' '.join(key): {'count': stat['count'],
+                                   'p50_us': quantile(stat['hist'], stat['count'], 0.5, stat['max']),
+                                   'p99_us': quantile(stat['hist'], stat['count'], 0.99, stat['max']),
+                                   'max_us': stat['max']}
+                    for key, stat in ops.items()},
+            'orphans': {node: {'count': n, 'perSecond': n / window} for node, n in orphans.items()},
+            'orphanTotal': orphanTotal,
+            'malformed': self.malformed,
+        }
+
+# Upper bound of the histogram bucket holding quantile q (never more than the observed max)
+def quantile(hist, count, q, maximum, perOctave=BUCKETS_PER_OCTAVE):
+    rank = q * count
+    seen = 0
+    for b in sorted(hist):
+        seen += hist[b]
+        if seen >= rank:
+            return min(int(bucketUpper(b, perOctave)), maximum)
+    return maximum
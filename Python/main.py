@@ -5,7 +5,9 @@ import couchbase.exceptions as CBErr
 import json
 from time import sleep, time
 
-import couchbase, logging
+import couchbase, logging, atexit
+from connections import ConnectionManager
+from errorPolicy import describe
 couchbase.enable_logging() # allows us to see warnings for slow/orphaned operations
 
 # set logging to WARNING level so we can see warnings
@@ -15,20 +17,28 @@ logging.getLogger().addHandler(ch)
 
 
 CONN_STR = 'couchbase://10.143.191.101,10.143.191.102,10.143.191.103'
-cluster = Cluster(CONN_STR)
-authenticator = PasswordAuthenticator('Danzibob', 'C0uchbase123')
-cluster.authenticate(authenticator)
-bucket = cluster.open_bucket('travel-sample')
-print("Connected.")
-
-# Threshold logging
-bucket.tracing_threshold_queue_flush_interval = 300000 # 5 minutes
-bucket.tracing_threshold_queue_size = 5
-bucket.tracing_threshold_kv = 5000 # 5 ms
-
-
+def openBucket():
+    cluster = Cluster(CONN_STR)
+    authenticator = PasswordAuthenticator('Danzibob', 'C0uchbase123')
+    cluster.authenticate(authenticator)
+    bucket = cluster.open_bucket('travel-sample')
+    print("Connected.")
+
+    # Threshold logging
+    bucket.tracing_threshold_queue_flush_interval = 300000 # 5 minutes
+    bucket.tracing_threshold_queue_size = 5
+    bucket.tracing_threshold_kv = 5000 # 5 ms
+    return bucket
+
+# Connects on first use rather than at import (see connections.py)
+connections = ConnectionManager(openBucket, poolSize=1)
+atexit.register(connections.close)
+bucket = connections.proxy()
+
+
+# Error class and code, without picking the message apart (see errorPolicy.py)
 def getHint(err):
-    return str(err).split(", ")[1]
+    return describe(err)
 
 class RetriesExceededException(Exception):
     pass
@@ -171,10 +181,10 @@ def upsertAndCheck(docID, value):
 # If server side failure is suspected, this function returns the set of nodes which are currently unavailable
 # The ping() and diagnotics() functions aren't documented anywhere?
 # Useful if there are some errors detected to determine whether to give up and fail gracefully
+# (health.HealthMonitor does this on a background thread, see clean.startHealthMonitor)
 def getDownNodes():
-    print(bucket.ping())
-    # What do the status numbers mean??
-    nodes = [x['server'].split(':')[0] for x in bucket.ping()['kv'] if x['status'] == 0 ]
+    # A status of 0 means the node answered
+    return [x['server'].split(':')[0] for x in bucket.ping()['kv'] if x['status'] != 0 ]
 
 """
 Working with N1QL queries
@@ -225,13 +235,14 @@ def N1QLFetchAirports(search, field='airportname'):
     return res
 
 
-res = N1QLFetchAirports("ard")
-maxlen = max([len(r.value["airportname"]) for k,r in res.items()])
-for k,r in res.items():
-    print("{0:{2}} ({1})".format(r.value['airportname'], r.value['city'], maxlen + 2))
-    print("...")
-    break
-#N1QLFetchAirports("per","city")
+if __name__ == "__main__":
+    res = N1QLFetchAirports("ard")
+    maxlen = max([len(r.value["airportname"]) for k,r in res.items()])
+    for k,r in res.items():
+        print("{0:{2}} ({1})".format(r.value['airportname'], r.value['city'], maxlen + 2))
+        print("...")
+        break
+    #N1QLFetchAirports("per","city")
 
 # print("Printing Down Nodes")
 # print(getDownNodes())
@@ -254,6 +265,8 @@ for k,r in res.items():
 
 # Monitoring - ???
 # Manually keep track of failures, operation times etc.??
+#   metrics.py does this for the helpers in clean.py: outcome (primary/retry/replica...) and latency
+#   per function and node, as a snapshot or a Prometheus text file
 # Manually parse logs ?????
 
 """ Questions for sdk peeps
@@ -0,0 +1,136 @@
+import threading, os, time
+from logStats import bucketFor, quantile
+
+# In-process metrics for the helpers in clean.py: how each call resolved (primary, retry, replica, ...)
+# and how long it took, per function, outcome and node.
+#   metrics.record('getOrRetry', 'retry', '10.143.191.102', seconds)
+#   metrics.count('retryBudget', 'exhausted', '10.143.191.102')
+#   print(metrics.snapshot())
+#   metrics.writePrometheus('/var/lib/node_exporter/couchbase.prom')
+# Each thread records into its own shard, so recording takes no lock; a snapshot merges the shards.
+# Latencies go into log-linear histograms (HDR style): 16 buckets per power of 2, so every
+# reported quantile is within ~4.5% of the real value, from 1us up, in a few hundred bytes per key
+
+BUCKETS_PER_OCTAVE = 16
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+class Metrics:
+    def __init__(self):
+        self.local = threading.local()
+        # (timings, counters) for every thread that has recorded something
+        self.shards = []
+        self.lock = threading.Lock()
+        self.dumper = None
+
+    def addShard(self):
+        shard = self.local.shard = ({}, {})
+        with self.lock:
+            self.shards.append(shard)
+        return shard
+
+    def record(self, function, outcome, node, seconds):
+        try:
+            timings = self.local.shard[0]
+        except AttributeError:
+            timings = self.addShard()[0]
+        key = (function, outcome, node)
+        # [count, sum (s), max (us), {bucket: count}]
+        t = timings.get(key)
+        if t is None: t = timings[key] = [0, 0.0, 0, {}]
+        us = seconds * 1000000
+        t[0] += 1
+        t[1] += seconds
+        if us > t[2]: t[2] = us
+        b = bucketFor(us, BUCKETS_PER_OCTAVE)
+        hist = t[3]
+        hist[b] = hist.get(b, 0) + 1
+
+    # Counts an event that has no duration (e.g. a retry refused by the budget)
+    def count(self, function, outcome, node='', n=1):
+        try:
+            counters = self.local.shard[1]
+        except AttributeError:
+            counters = self.addShard()[1]
+        key = (function, outcome, node)
+        counters[key] = counters.get(key, 0) + n
+
+    # Merged totals of every shard. Shards are copied without stopping their threads,
+    # so a snapshot taken mid-recording may be off by the calls in progress
+    def merged(self):
+        with self.lock:
+            shards = list(self.shards)
+        timings, counters = {}, {}
+        for shardTimings, shardCounters in shards:
+            for key, (count, total, maximum, hist) in list(shardTimings.items()):
+                t = timings.get(key)
+                if t is None: t = timings[key] = [0, 0.0, 0, {}]
+                t[0] += count
+                t[1] += total
+                t[2] = max(t[2], maximum)
+                for b, n in hist.copy().items():
+                    t[3][b] = t[3].get(b, 0) + n
+            for key, n in list(shardCounters.items()):
+                counters[key] = counters.get(key, 0) + n
+        return timings, counters
+
+    def snapshot(self):
+        timings, counters = self.merged()
+        ops = {}
+        for (function, outcome, node), (count, total, maximum, hist) in timings.items():
+            stat = {'count': count, 'mean_us': int(total * 1000000 / count), 'max_us': int(maximum)}
+            for q in QUANTILES:
+                stat['p' + str(q * 100).rstrip('0').rstrip('.') + '_us'] = int(quantile(hist, count, q, maximum, BUCKETS_PER_OCTAVE))
+            ops.setdefault(function, {}).setdefault(outcome, {})[node] = stat
+        events = {}
+        for (function, outcome, node), n in counters.items():
+            events.setdefault(function, {}).setdefault(outcome, {})[node] = n
+        return {'ops': ops, 'events': events}
+
+    # Prometheus text exposition format: a summary per function/outcome/node and a counter per event
+    def prometheus(self, prefix='couchbase'):
+        timings, counters = self.merged()
+        lines = ['# HELP %s_op_seconds Duration of helper calls by function, outcome path and node' % prefix,
+                 '# TYPE %s_op_seconds summary' % prefix]
+        for (function, outcome, node), (count, total, maximum, hist) in sorted(timings.items()):
+            labels = 'function="%s",outcome="%s",node="%s"' % (function, outcome, node)
+            for q in QUANTILES:
+                lines.append('%s_op_seconds{%s,quantile="%s"} %.9g' % (prefix, labels, q, quantile(hist, count, q, maximum, BUCKETS_PER_OCTAVE) / 1000000))
+            lines.append('%s_op_seconds_sum{%s} %.9g' % (prefix, labels, total))
+            lines.append('%s_op_seconds_count{%s} %d' % (prefix, labels, count))
+        lines += ['# HELP %s_events_total Helper events by function, outcome and node' % prefix,
+                  '# TYPE %s_events_total counter' % prefix]
+        for (function, outcome, node), n in sorted(counters.items()):
+            lines.append('%s_events_total{function="%s",outcome="%s",node="%s"} %d' % (prefix, function, outcome, node, n))
+        return '\n'.join(lines) + '\n'
+
+    # Written to a temporary file then renamed, so a scraper (e.g. node_exporter's
+    # textfile collector) never reads a half written file
+    def writePrometheus(self, path, prefix='couchbase'):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp, path)
+
+    # Rewrites the dump every interval seconds from a background thread
+    def dumpEvery(self, path, interval=15):
+        if self.dumper is None:
+            self.dumper = threading.Thread(target=self.dumpLoop, args=(path, interval), name='MetricsDump', daemon=True)
+            self.dumper.start()
+        return self.dumper
+
+    def dumpLoop(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.writePrometheus(path)
+            except OSError:
+                pass
+
+    # Drops everything recorded so far
+    def reset(self):
+        with self.lock:
+            for timings, counters in self.shards:
+                timings.clear()
+                counters.clear()
+
+metrics = Metrics()
@@ -0,0 +1,63 @@
+import threading, hashlib, uuid
+from couchbase.n1ql import N1QLQuery, N1QLError
+
+# Query service error codes meaning a prepared plan can't be used any more
+# (statement unknown to this query node, plan out of date, index it used was dropped/failed over, ...)
+REPREPARE_CODES = {4040, 4050, 4060, 4070, 4080, 4090, 12016}
+
+def planInvalid(err):
+    info = getattr(err, 'objextra', None) or {}
+    return isinstance(info, dict) and info.get('code') in REPREPARE_CODES
+
+# Prepares each distinct statement once per bucket connection and runs it with EXECUTE,
+# so the query service doesn't parse and plan the same string on every call.
+# Use one registry per connection: names are unique to it, so two clients never share a plan
+class PreparedStatements:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.prefix = 'eh_' + uuid.uuid4().hex[:8] + '_'
+        self.names = {}
+        self.lock = threading.Lock()
+        self.stats = {'prepared': 0, 'reprepared': 0, 'executed': 0}
+
+    def prepare(self, statement):
+        with self.lock:
+            # A plan being replaced keeps its old name on the server, so every prepare gets a new one
+            if statement in self.names: self.stats['reprepared'] += 1
+            self.stats['prepared'] += 1
+            name = self.prefix + hashlib.sha1(statement.encode()).hexdigest()[:16] + '_' + str(self.stats['prepared'])
+        self.bucket.n1ql_query(N1QLQuery('PREPARE `' + name + '` FROM ' + statement)).execute()
+        with self.lock:
+            self.names[statement] = name
+        return name
+
+    def getName(self, statement):
+        with self.lock:
+            name = self.names.get(statement)
+        return name if name is not None else self.prepare(statement)
+
+    # Same as iterating bucket.n1ql_query(N1QLQuery(statement, *params)).
+    # Like an ad-hoc query errors only show up once rows are read. If the plan has been invalidated
+    # (detected before any row is returned) the statement is prepared again and run once more
+    def query(self, statement, *params):
+        name = self.getName(statement)
+        for attempt in range(2):
+            rows = iter(self.bucket.n1ql_query(N1QLQuery('EXECUTE `' + name + '`', *params)))
+            try:
+                first = next(rows)
+            except StopIteration:
+                first = None
+            except N1QLError as e:
+                if attempt or not planInvalid(e): raise
+                name = self.prepare(statement)
+                continue
+            with self.lock:
+                self.stats['executed'] += 1
+            if first is None: return
+            yield first
+            yield from rows
+            return
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, statements=len(self.names))
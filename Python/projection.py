@@ -0,0 +1,118 @@
+import sys, math
+from array import array
+
+# Compact forms for large result sets that keep only the fields the caller uses,
+# instead of a dict per row (N1QL) or a result object wrapping the whole document (get_multi).
+#   rows = project(results, ('airportname', 'city'))                  # list of slotted records
+#   cols = project(results, ('airportname', 'city'), columnar=True)   # one array per field
+#   for row in projectIter(results, ('airportname', 'city')): ...     # records as rows stream in
+# Rows can be N1QL row dicts, SDK results (their .value is used) or (key, result) pairs.
+# Strings are interned, so repeated values (cities, countries) are stored once; numeric fields
+# of a columnar result are kept in array('d') columns (missing values are nan).
+# Either way rows are read as row['airportname'] or row.get('city'), like the dicts they replace
+
+# Base class for the per-field record types made by recordType
+class Record:
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def toDict(self):
+        return {f: getattr(self, f) for f in self.fields}
+
+    def __repr__(self):
+        return 'Record(' + ', '.join(f + '=' + repr(getattr(self, f)) for f in self.fields) + ')'
+
+recordTypes = {}
+
+# A Record subclass with one slot per field (fields must be valid identifiers)
+def recordType(fields):
+    fields = tuple(fields)
+    t = recordTypes.get(fields)
+    if t is None:
+        for f in fields:
+            if not f.isidentifier() or f == 'fields':
+                raise ValueError("Can't project field " + repr(f))
+        t = recordTypes[fields] = type('Record', (Record,), {'__slots__': fields, 'fields': fields})
+    return t
+
+def intern(v):
+    return sys.intern(v) if type(v) is str else v
+
+def rowValue(row):
+    if type(row) is tuple: row = row[1]
+    return row if type(row) is dict else row.value
+
+def projectIter(rows, fields):
+    t = recordType(fields)
+    fields = t.fields
+    for row in rows:
+        value = rowValue(row)
+        record = t.__new__(t)
+        for f in fields:
+            setattr(record, f, intern(value.get(f)))
+        yield record
+
+# Column per field. Rows are views (ColumnRow) made on access, so nothing per row is kept
+class Columns:
+    def __init__(self, fields, numeric=()):
+        self.fields = tuple(fields)
+        self.columns = {f: array('d') if f in numeric else [] for f in self.fields}
+        self.length = 0
+
+    def append(self, value):
+        for f, column in self.columns.items():
+            v = value.get(f)
+            if type(column) is array: column.append(math.nan if v is None else v)
+            else: column.append(intern(v))
+        self.length += 1
+
+    def column(self, field):
+        return self.columns[field]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0: index += self.length
+        if not 0 <= index < self.length: raise IndexError(index)
+        return ColumnRow(self, index)
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield ColumnRow(self, i)
+
+class ColumnRow:
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.table.columns[field][self.index]
+
+    def get(self, field, default=None):
+        column = self.table.columns.get(field)
+        return default if column is None else column[self.index]
+
+    def toDict(self):
+        return {f: c[self.index] for f, c in self.table.columns.items()}
+
+    def __repr__(self):
+        return 'ColumnRow(' + repr(self.toDict()) + ')'
+
+def project(rows, fields, columnar=False, numeric=()):
+    if not columnar: return list(projectIter(rows, fields))
+    table = Columns(fields, numeric)
+    for row in rows:
+        table.append(rowValue(row))
+    return table
@@ -0,0 +1,91 @@
+import threading, time
+
+# Raised instead of retrying (or reading a replica) once the retry budget is used up
+class RetryBudgetExceededException(Exception):
+    pass
+
+# Process-wide limit on retries and replica fallbacks, so a node dropping out can't turn
+# every in-flight request into several.
+# Token bucket: each successful first attempt earns ratio tokens (e.g. 0.1 = retries may add
+# 10% on top of normal traffic), plus minPerSecond tokens a second so a quiet client can still
+# retry, up to maxTokens. Every retry spends a token. On top of that no more than
+# perNodeConcurrency retries may be in flight against one node at a time. A node is a host name,
+# or a set of them for a batch, which takes a slot on each
+class RetryBudget:
+    def __init__(self, ratio=0.1, minPerSecond=10, maxTokens=100, perNodeConcurrency=16):
+        self.ratio = ratio
+        self.minPerSecond = minPerSecond
+        self.maxTokens = maxTokens
+        self.perNodeConcurrency = perNodeConcurrency
+        self.tokens = maxTokens
+        self.refilledAt = time.monotonic()
+        self.inFlight = {}
+        self.lock = threading.Lock()
+        self.stats = {'successes': 0, 'retries': 0, 'shedBudget': 0, 'shedConcurrency': 0}
+
+    def recordSuccess(self, n=1):
+        with self.lock:
+            self.stats['successes'] += n
+            self.tokens = min(self.maxTokens, self.tokens + n * self.ratio)
+
+    # Takes n tokens (and a concurrency slot on node, if given) if they are available.
+    # Never waits: returns False straight away if the retry should be shed
+    def tryAcquire(self, node=None, n=1):
+        nodes = nodesOf(node)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.maxTokens, self.tokens + (now - self.refilledAt) * self.minPerSecond)
+            self.refilledAt = now
+            if self.tokens < n:
+                self.stats['shedBudget'] += n
+                return False
+            if any(self.inFlight.get(x, 0) >= self.perNodeConcurrency for x in nodes):
+                self.stats['shedConcurrency'] += n
+                return False
+            for x in nodes:
+                self.inFlight[x] = self.inFlight.get(x, 0) + 1
+            self.tokens -= n
+            self.stats['retries'] += n
+            return True
+
+    def release(self, node=None):
+        nodes = nodesOf(node)
+        if not nodes: return
+        with self.lock:
+            for x in nodes:
+                self.inFlight[x] -= 1
+
+    # with budget.spend(node): ...retry...
+    def spend(self, node=None, n=1):
+        slot = self.trySpend(node, n)
+        if slot is None:
+            raise RetryBudgetExceededException("Retry budget exhausted" + (" for node " + ', '.join(nodesOf(node)) if node else ""))
+        return slot
+
+    # Same, but None rather than raising
+    def trySpend(self, node=None, n=1):
+        return BudgetSlot(self, node) if self.tryAcquire(node, n) else None
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, tokens=self.tokens, inFlight=dict(self.inFlight))
+
+def nodesOf(node):
+    if node is None: return ()
+    return (node,) if isinstance(node, str) else node
+
+# Concurrency slot taken by spend(), given back by release() or leaving the with block
+class BudgetSlot:
+    def __init__(self, budget, node):
+        self.budget = budget
+        self.node = node
+
+    def release(self):
+        self.budget.release(self.node)
+        self.node = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,201 @@
+import mmap, os, struct, threading, time, json, zlib, hashlib, fcntl, tempfile, contextlib
+
+# Document cache shared by every process on the host, in one fixed-size memory mapped file
+# (in /dev/shm, so it lives in memory), e.g. under each worker's DocCache:
+#   shared = SharedCache('cb-reference')
+#   fetch = shared.readThrough(getNormalOrReplica, ttl=300)
+# The file is a header, a table of slots and a data area. A key hashes to a slot and is looked for
+# in the next maxProbe slots (open addressing); a full window evicts its oldest entry. A slot holds
+# the document's CAS, when it was stored and where its key + value (JSON) are in the data area,
+# which is filled as a ring, oldest data overwritten first.
+# Reads take no lock: each slot has a sequence number that a writer makes odd while changing the slot
+# and even again after, so a reader that saw it odd or changed retries (a seqlock), and a checksum
+# over key + value catches data the ring has since overwritten. Only the slot and header are read in
+# place; the value is copied out once, as it has to be validated before it's decoded.
+# Writers (any process) take a lockf lock on the file. Not flock: an flock belongs to the open file,
+# which workers forked after the cache was made share, so it wouldn't keep them apart. A put never replaces a newer CAS with an older one.
+# NB: the seqlock relies on stores becoming visible in order, as on x86
+
+MAGIC = b'CBSHMC01'
+HEADER = struct.Struct('<8sIII4xQ')
+HEAD_OFFSET = 24
+# seq, crc, keyHash, cas, offset, length, storedAt, keyLen
+SLOT = struct.Struct('<IIQQIIdH6x')
+SEQ = struct.Struct('<I')
+
+def keyHash(keyBytes):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(keyBytes, digest_size=8).digest(), 'little') | 1
+
+def defaultDir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Stands in for an SDK result for documents served from the shared cache
+class CachedResult:
+    def __init__(self, key, value, cas):
+        self.key = key
+        self.value = value
+        self.cas = cas
+        self.rc = 0
+        self.success = True
+
+class SharedCache:
+    def __init__(self, name, slots=65536, dataBytes=64*1024*1024, maxProbe=8, directory=None):
+        self.path = os.path.join(directory or defaultDir(), name)
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'puts': 0, 'older': 0, 'retries': 0}
+        self.file = open(self.path, 'a+b')
+        # A fork while another thread held the lock would leave it held in the child for good
+        os.register_at_fork(after_in_child=self.resetLock)
+        with self.locked():
+            if os.fstat(self.file.fileno()).st_size == 0:
+                self.file.truncate(HEADER.size + slots * SLOT.size + dataBytes)
+                self.mm = mmap.mmap(self.file.fileno(), 0)
+                HEADER.pack_into(self.mm, 0, MAGIC, slots, maxProbe, dataBytes, 0)
+            else:
+                self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, self.slots, self.maxProbe, self.dataBytes, head = HEADER.unpack_from(self.mm)
+        if magic != MAGIC: raise ValueError(self.path + " is not a shared cache")
+        self.dataStart = HEADER.size + self.slots * SLOT.size
+
+    def resetLock(self):
+        self.lock = threading.Lock()
+
+    # Excludes other threads (the lock) and other processes (the lockf lock, which is per process)
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.file.fileno(), fcntl.LOCK_UN)
+
+    def window(self, h):
+        first = h % self.slots
+        for i in range(self.maxProbe):
+            yield HEADER.size + ((first + i) % self.slots) * SLOT.size
+
+    # (value bytes, cas, storedAt) or None
+    def lookup(self, keyBytes):
+        h = keyHash(keyBytes)
+        mm = self.mm
+        for pos in self.window(h):
+            for attempt in range(100):
+                seq, crc, slotHash, cas, offset, length, storedAt, keyLen = SLOT.unpack_from(mm, pos)
+                if seq & 1:
+                    self.stats['retries'] += 1
+                    continue
+                if slotHash != h:
+                    if slotHash == 0: return None
+                    break
+                start = self.dataStart + offset
+                data = mm[start:start+length]
+                if SEQ.unpack_from(mm, pos)[0] != seq:
+                    self.stats['retries'] += 1
+                    continue
+                if zlib.crc32(data) != crc or data[:keyLen] != keyBytes: return None
+                return data[keyLen:], cas, storedAt
+        return None
+
+    # (value, cas, storedAt) or None
+    def getEntry(self, key):
+        found = self.lookup(key.encode())
+        if found is None: return None
+        data, cas, storedAt = found
+        return json.loads(data), cas, storedAt
+
+    # A CachedResult, or None if missing or older than ttl seconds
+    def get(self, key, ttl=None):
+        entry = self.getEntry(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        value, cas, storedAt = entry
+        if ttl is not None and time.time() - storedAt > ttl:
+            self.stats['expired'] += 1
+            return None
+        self.stats['hits'] += 1
+        return CachedResult(key, value, cas)
+
+    def put(self, key, value, cas):
+        keyBytes = key.encode()
+        data = keyBytes + json.dumps(value, separators=(',', ':')).encode()
+        # Too big to be worth a quarter of the ring
+        if len(data) > self.dataBytes // 4: return False
+        h = keyHash(keyBytes)
+        mm = self.mm
+        with self.locked():
+            target = None
+            oldest = None
+            for pos in self.window(h):
+                seq, crc, slotHash, slotCas, offset, length, storedAt, keyLen = SLOT.unpack_from(mm, pos)
+                if slotHash == h:
+                    if cas < slotCas:
+                        self.stats['older'] += 1
+                        return False
+                    target = pos
+                    break
+                if slotHash == 0:
+                    target = pos
+                    break
+                if oldest is None or storedAt < oldest[1]: oldest = (pos, storedAt)
+            if target is None: target = oldest[0]
+            head = struct.unpack_from('<Q', mm, HEAD_OFFSET)[0]
+            if head + len(data) > self.dataBytes: head = 0
+            mm[self.dataStart+head:self.dataStart+head+len(data)] = data
+            struct.pack_into('<Q', mm, HEAD_OFFSET, head + len(data))
+            seq = SEQ.unpack_from(mm, target)[0]
+            SEQ.pack_into(mm, target, seq + 1)
+            SLOT.pack_into(mm, target, seq + 1, zlib.crc32(data), h, cas, head, len(data), time.time(), len(keyBytes))
+            SEQ.pack_into(mm, target, seq + 2)
+            self.stats['puts'] += 1
+        return True
+
+    # Marks key's entry as expired, so the next readThrough fetches it again. The slot stays in use:
+    # emptying it would end the probe for keys stored after it
+    def invalidate(self, key):
+        keyBytes = key.encode()
+        h = keyHash(keyBytes)
+        mm = self.mm
+        with self.locked():
+            for pos in self.window(h):
+                seq, crc, slotHash, cas, offset, length, storedAt, keyLen = SLOT.unpack_from(mm, pos)
+                if slotHash == 0: return False
+                if slotHash != h: continue
+                SEQ.pack_into(mm, pos, seq + 1)
+                SLOT.pack_into(mm, pos, seq + 1, crc, h, cas, offset, length, 0.0, keyLen)
+                SEQ.pack_into(mm, pos, seq + 2)
+                return True
+        return False
+
+    # Wraps fetch (e.g. getNormalOrReplica) so it is only called when no process has fetched the
+    # document in the last ttl seconds; what it returns is stored for the others.
+    # If fetch fails with one of staleOn an expired entry is served instead, if there is one
+    def readThrough(self, fetch, ttl=60, staleOn=()):
+        def get(docID):
+            entry = self.getEntry(docID)
+            if entry is not None and time.time() - entry[2] <= ttl:
+                self.stats['hits'] += 1
+                return CachedResult(docID, entry[0], entry[1])
+            self.stats['misses' if entry is None else 'expired'] += 1
+            try:
+                result = fetch(docID)
+            except staleOn:
+                if entry is None: raise
+                return CachedResult(docID, entry[0], entry[1])
+            self.put(docID, result.value, result.cas)
+            return result
+        return get
+
+    def getStats(self):
+        used = sum(SLOT.unpack_from(self.mm, HEADER.size + i * SLOT.size)[2] != 0 for i in range(self.slots))
+        return dict(self.stats, slots=self.slots, used=used, dataBytes=self.dataBytes)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    # Removes the file, the cache goes away once every process has closed it
+    def unlink(self):
+        os.unlink(self.path)
@@ -0,0 +1,67 @@
+import threading, asyncio
+
+# Single-flight: while a call for a key is in progress, other callers for the same key wait for it
+# and get its result (or exception) instead of making their own call.
+# The first caller runs fn, including any retries and replica fallback it does, the rest just wait.
+#   flights = SingleFlight()
+#   result = flights.do(docID, lambda: getRetryThenReplica(docID))
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            self.stats['calls'] += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Flight()
+            else:
+                self.stats['shared'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, inFlight=len(self.calls))
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# asyncio version: concurrent coroutines awaiting the same key share one task.
+#   result = await flights.do(docID, lambda: getRetryThenReplicaAsync(docID))
+# A waiter being cancelled doesn't cancel the shared call for everyone else
+class AsyncSingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    async def do(self, key, fn):
+        self.stats['calls'] += 1
+        task = self.calls.get(key)
+        if task is not None:
+            self.stats['shared'] += 1
+        else:
+            task = self.calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self.calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    def getStats(self):
+        return dict(self.stats, inFlight=len(self.calls))
@@ -0,0 +1,181 @@
+import contextvars, threading, functools, random, time, json
+from collections import deque
+
+# Lightweight tracing for the resilience helpers.
+#   spans.startTracing(spans.FileExporter('spans.jsonl'), spans.RateLimitingSampler(10))
+# Functions decorated with @traced() get a span, and span('attempt') etc. inside them add child spans.
+# Only some traces are sampled (the sampler decides once per top-level call), but a top-level call
+# that raises is always recorded, as a single span. Finished spans go into a bounded ring that a
+# background thread empties into the exporter in batches, so nothing is written on the calling thread.
+# Until startTracing() is called (or when a call isn't sampled) the decorator and span() do next to nothing
+
+currentSpan = contextvars.ContextVar('currentSpan', default=None)
+# Marks the context of a call that wasn't sampled, so nested traced functions don't sample again
+UNSAMPLED = 'unsampled'
+tracer = None
+
+class Span:
+    __slots__ = ('tracer', 'name', 'traceID', 'spanID', 'parentID', 'tags', 'start', 'duration', 'error', 'token', 't0')
+
+    def __init__(self, tracer, name, parent=None, tags=None):
+        self.tracer = tracer
+        self.name = name
+        self.spanID = random.getrandbits(64)
+        self.traceID = parent.traceID if parent else random.getrandbits(64)
+        self.parentID = parent.spanID if parent else None
+        self.tags = tags or {}
+        self.error = None
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.token = currentSpan.set(self)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.duration = time.perf_counter() - self.t0
+        if exc is not None: self.error = excType.__name__ + ': ' + str(exc)
+        currentSpan.reset(self.token)
+        self.tracer.record(self)
+        return False
+
+    def toDict(self):
+        return {'name': self.name, 'traceID': '%016x' % self.traceID, 'spanID': '%016x' % self.spanID,
+                'parentID': '%016x' % self.parentID if self.parentID else None, 'start': self.start,
+                'durationUs': int(self.duration * 1000000), 'error': self.error, 'tags': self.tags}
+
+class NoopSpan:
+    def tag(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NOOP = NoopSpan()
+
+# Samples at most perSecond traces a second (token bucket, so short bursts are allowed)
+class RateLimitingSampler:
+    def __init__(self, perSecond=10):
+        self.perSecond = perSecond
+        self.tokens = perSecond
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def sample(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.perSecond, self.tokens + (now - self.updated) * self.perSecond)
+            self.updated = now
+            if self.tokens < 1: return False
+            self.tokens -= 1
+            return True
+
+# Keeps the last maxSpans spans (as dicts) in memory, for tests and offline analysis
+class InMemoryExporter:
+    def __init__(self, maxSpans=100000):
+        self.spans = deque(maxlen=maxSpans)
+
+    def export(self, batch):
+        self.spans.extend(batch)
+
+# Appends spans to a file, one JSON object per line
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, batch):
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(s) + '\n' for s in batch))
+
+class Tracer:
+    def __init__(self, exporter, sampler=None, ringSize=10000, batchSize=500, interval=1):
+        self.exporter = exporter
+        self.sampler = sampler or RateLimitingSampler()
+        self.ring = deque(maxlen=ringSize)
+        self.batchSize = batchSize
+        self.interval = interval
+        self.dropped = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='SpanExporter', daemon=True)
+        self.thread.start()
+
+    def record(self, span):
+        # The ring is bounded: when export falls behind the oldest spans are dropped
+        if len(self.ring) == self.ring.maxlen: self.dropped += 1
+        self.ring.append(span)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.exportPending()
+
+    def exportPending(self):
+        while self.ring:
+            batch = []
+            while self.ring and len(batch) < self.batchSize:
+                batch.append(self.ring.popleft().toDict())
+            try:
+                self.exporter.export(batch)
+            except Exception:
+                self.dropped += len(batch)
+
+    # Runs an unsampled call, recording it only if it fails
+    def runUnsampled(self, name, fn, args, kwargs):
+        token = currentSpan.set(UNSAMPLED)
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            s = Span(self, name, tags={'sampled': False})
+            s.start = time.time() - (time.perf_counter() - t0)
+            s.duration = time.perf_counter() - t0
+            s.error = type(e).__name__ + ': ' + str(e)
+            self.record(s)
+            raise
+        finally:
+            currentSpan.reset(token)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.exportPending()
+
+def startTracing(exporter, sampler=None, **options):
+    global tracer
+    stopTracing()
+    tracer = Tracer(exporter, sampler, **options)
+    return tracer
+
+def stopTracing():
+    global tracer
+    if tracer is not None:
+        t, tracer = tracer, None
+        t.close()
+
+# Decorator: a span named after the function (tagged with its first argument, e.g. the key)
+def traced(name=None):
+    def decorate(fn):
+        spanName = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = tracer
+            if t is None: return fn(*args, **kwargs)
+            parent = currentSpan.get()
+            if parent is UNSAMPLED: return fn(*args, **kwargs)
+            if parent is None and not t.sampler.sample():
+                return t.runUnsampled(spanName, fn, args, kwargs)
+            with Span(t, spanName, parent, {'key': args[0]} if args else None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Child span of the current span, e.g. with span('backoff', ms=delay): ...
+def span(name, **tags):
+    parent = currentSpan.get()
+    if parent is None or parent is UNSAMPLED: return NOOP
+    return Span(parent.tracer, name, parent, tags)
@@ -0,0 +1,177 @@
+import mmap, os, struct, bisect, threading
+from array import array
+
+# Local substring index over one field of a set of documents (e.g. airport names), so a
+# '%man%' search is answered from a file instead of a leading-wildcard scan on the query service.
+#   index = TrigramIndex.build(rows, 'airports.trigrams')   # rows of (id, text, cas)
+#   index = TrigramIndex('airports.trigrams')
+#   index.search('man')  ->  ids whose text contains 'man' (case insensitive)
+# Every 3 character substring of each (lowercased) text points to the documents containing it,
+# so a search intersects the posting lists of its trigrams, then checks the candidates' text.
+# The file is memory mapped and only read, so opening it is instant and it's shared between processes:
+#   header | cas per doc (Q) | trigram keys, sorted (Q) | text offsets (I) | posting starts (I) | postings (I) | text
+# Changes (update/remove, e.g. from documents with a newer CAS) are kept in memory on top of the
+# file until save() writes a new one. Searches and updates can run on several threads at once
+
+MAGIC = b'CBTRI001'
+HEADER = struct.Struct('<8sIIII8x')
+
+def gramKey(gram):
+    return (ord(gram[0]) << 42) | (ord(gram[1]) << 21) | ord(gram[2])
+
+def gramsOf(text):
+    return {gramKey(text[i:i+3]) for i in range(len(text) - 2)}
+
+class TrigramIndex:
+    def __init__(self, path):
+        self.path = path
+        # id -> (lowercased text, cas), or (None, cas) if removed. Changed under lock, read from snapshots
+        self.changed = {}
+        self.lock = threading.Lock()
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.docCount, self.gramCount, postingCount, textSize = HEADER.unpack_from(self.mm)
+        if magic != MAGIC: raise ValueError(self.path + " is not a trigram index")
+        view = self.view = memoryview(self.mm)
+        pos = HEADER.size
+        def section(fmt, count):
+            nonlocal pos
+            size = struct.calcsize(fmt) * count
+            s = view[pos:pos+size].cast(fmt)
+            pos += size
+            return s
+        self.cas = section('Q', self.docCount)
+        self.gramKeys = section('Q', self.gramCount)
+        self.textOffsets = section('I', self.docCount + 1)
+        self.postingStarts = section('I', self.gramCount + 1)
+        self.postings = section('I', postingCount)
+        self.text = view[pos:pos+textSize]
+
+    # Writes an index of rows, (id, text, cas), to path and opens it
+    @classmethod
+    def build(cls, rows, path):
+        write(rows, path)
+        return cls(path)
+
+    # id and lowercased text of document number n in the file
+    def doc(self, n):
+        docID, text = bytes(self.text[self.textOffsets[n]:self.textOffsets[n+1]]).decode().split('\0', 1)
+        return docID, text
+
+    def posting(self, key):
+        i = bisect.bisect_left(self.gramKeys, key)
+        if i == self.gramCount or self.gramKeys[i] != key: return ()
+        return self.postings[self.postingStarts[i]:self.postingStarts[i+1]]
+
+    def candidates(self, text):
+        grams = gramsOf(text)
+        # Shorter than a trigram: every document is a candidate
+        if not grams: return range(self.docCount)
+        lists = sorted((self.posting(g) for g in grams), key=len)
+        result = set(lists[0])
+        for l in lists[1:]:
+            if not result: break
+            result.intersection_update(l)
+        return sorted(result)
+
+    # Ids of documents whose text contains text, in id order
+    def search(self, text):
+        text = text.lower()
+        with self.lock:
+            changed = dict(self.changed)
+        ids = []
+        for n in self.candidates(text):
+            docID, docText = self.doc(n)
+            if text in docText and docID not in changed: ids.append(docID)
+        ids += [docID for docID, (docText, cas) in changed.items() if docText is not None and text in docText]
+        return sorted(ids)
+
+    # Records a document's new text (ignored if cas isn't newer than what the index has)
+    def update(self, docID, text, cas):
+        with self.lock:
+            if cas <= self.casOf(docID): return False
+            self.changed[docID] = (text.lower(), cas)
+            return True
+
+    def remove(self, docID, cas=0):
+        with self.lock:
+            self.changed[docID] = (None, max(cas, self.casOf(docID)))
+
+    def casOf(self, docID):
+        changed = self.changed.get(docID)
+        if changed is not None: return changed[1]
+        n = self.find(docID)
+        return self.cas[n] if n is not None else 0
+
+    # Document number of docID in the file (documents are stored in id order)
+    def find(self, docID):
+        lo, hi = 0, self.docCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc(mid)[0] < docID: lo = mid + 1
+            else: hi = mid
+        return lo if lo < self.docCount and self.doc(lo)[0] == docID else None
+
+    # Highest CAS seen, to ask the cluster only for documents changed since
+    def maxCas(self):
+        with self.lock:
+            changed = list(self.changed.values())
+        return max(max(self.cas, default=0), max((cas for text, cas in changed), default=0))
+
+    def rows(self):
+        with self.lock:
+            changed = dict(self.changed)
+        for n in range(self.docCount):
+            docID, text = self.doc(n)
+            if docID not in changed: yield docID, text, self.cas[n]
+        for docID, (text, cas) in changed.items():
+            if text is not None: yield docID, text, cas
+
+    # Writes the file again with the in-memory changes included
+    def save(self):
+        write(list(self.rows()), self.path)
+        self.close()
+        self.changed = {}
+        self.open()
+
+    def close(self):
+        for v in (self.cas, self.gramKeys, self.textOffsets, self.postingStarts, self.postings, self.text, self.view):
+            v.release()
+        self.mm.close()
+
+    def getStats(self):
+        with self.lock:
+            changed = len(self.changed)
+        return {'docs': self.docCount, 'trigrams': self.gramCount, 'postings': len(self.postings),
+                'bytes': len(self.mm), 'changed': changed}
+
+# Written to a temporary file then renamed, so readers never see half an index
+def write(rows, path):
+    docs = sorted((docID, text.lower(), cas) for docID, text, cas in rows)
+    cas = array('Q', (c for d, t, c in docs))
+    text = bytearray()
+    textOffsets = array('I', [0])
+    grams = {}
+    for n, (docID, docText, c) in enumerate(docs):
+        text += (docID + '\0' + docText).encode()
+        textOffsets.append(len(text))
+        for g in gramsOf(docText):
+            grams.setdefault(g, []).append(n)
+    gramKeys = array('Q', sorted(grams))
+    postingStarts = array('I', [0])
+    postings = array('I')
+    for g in gramKeys:
+        postings.extend(grams[g])
+        postingStarts.append(len(postings))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(docs), len(gramKeys), len(postings), len(text)))
+        for section in (cas, gramKeys, textOffsets, postingStarts, postings):
+            f.write(section.tobytes())
+        f.write(text)
+        # mmap can't map an empty file
+        if not docs: f.write(b'\0')
+    os.replace(tmp, path)
@@ -0,0 +1,75 @@
+import threading, time
+
+# Startup warm-up, so the first requests after a deploy don't pay for connecting, fetching the
+# cluster map and missing the cache on hot documents.
+#   warmup = Warmup(deadline=10)
+#   warmup.phase('connect', openConnections).phase('prefetch', prefetch)
+#   warmup.start()     # runs the phases in order on a background thread
+#   warmup.wait()      # True once ready
+# Each phase is called with the seconds left before the deadline, and what it returns goes in the stats.
+# Ready means every phase has finished or deadline seconds have passed, whichever comes first, so a slow
+# or partly down cluster holds readiness back by at most the deadline. Phases still running then carry
+# on in the background. A phase that raises is recorded and the next one still runs
+class Warmup:
+    def __init__(self, deadline=10):
+        self.deadline = deadline
+        self.phases = []
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        # name -> {'seconds': ..., 'result': ...} or {'seconds': ..., 'error': ...}
+        self.results = {}
+        self.started = None
+        self.readyAfter = None
+        self.timedOut = False
+        self.thread = None
+        self.timer = None
+
+    def phase(self, name, fn):
+        self.phases.append((name, fn))
+        return self
+
+    def start(self):
+        self.started = time.monotonic()
+        self.timer = threading.Timer(self.deadline, self.expire)
+        self.timer.daemon = True
+        self.timer.start()
+        self.thread = threading.Thread(target=self.run, name='Warmup', daemon=True)
+        self.thread.start()
+        return self
+
+    def remaining(self):
+        return max(0, self.started + self.deadline - time.monotonic())
+
+    def run(self):
+        for name, fn in self.phases:
+            start = time.perf_counter()
+            try:
+                result = {'result': fn(self.remaining())}
+            except Exception as e:
+                result = {'error': repr(e)}
+            result['seconds'] = time.perf_counter() - start
+            with self.lock:
+                self.results[name] = result
+        self.timer.cancel()
+        self.markReady()
+
+    def expire(self):
+        self.markReady(timedOut=True)
+
+    def markReady(self, timedOut=False):
+        with self.lock:
+            if self.ready.is_set(): return
+            self.timedOut = timedOut
+            self.readyAfter = time.monotonic() - self.started
+            self.ready.set()
+
+    def isReady(self):
+        return self.ready.is_set()
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def getStats(self):
+        with self.lock:
+            return {'ready': self.ready.is_set(), 'timedOut': self.timedOut, 'readyAfter': self.readyAfter,
+                    'phases': {name: dict(r) for name, r in self.results.items()}}
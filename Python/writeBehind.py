@@ -0,0 +1,113 @@
+import threading, time
+
+# Statuses returned by writeBatch, as in clean.upsertAndCheck_multi
+CONFIRMED, NOT_APPLIED, UNKNOWN = 'confirmed', 'not-applied', 'unknown'
+
+# Raised by put() when the buffer stays full for longer than its timeout
+class WriteBehindFullException(Exception):
+    pass
+
+# Opt-in write-behind for writes where last-write-wins is fine.
+# put() just records the value: repeated writes to a key before it is flushed collapse into one,
+# and a background thread writes the buffer in batches of up to maxBatch through
+# writeBatch(items) -> {key: status} (e.g. clean.upsertAndCheck_multi, which only checks ambiguous keys),
+# either once maxBatch keys are waiting or flushInterval seconds after the oldest one arrived.
+# Keys that come back not-applied or unknown are queued again (unless newer data has arrived)
+# up to maxAttempts times, then handed to onFailure(key, value, status).
+# With maxPending keys waiting put() blocks, so callers are slowed down rather than using unbounded memory.
+# close() flushes what is left before returning
+class WriteBehindBuffer:
+    def __init__(self, writeBatch, maxBatch=500, flushInterval=0.05, maxPending=10000, maxAttempts=3, onFailure=None):
+        self.writeBatch = writeBatch
+        self.maxBatch = maxBatch
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self.maxAttempts = maxAttempts
+        self.onFailure = onFailure
+        # key -> [value, attempts]
+        self.pending = {}
+        self.oldest = None
+        self.writing = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.stats = {'puts': 0, 'coalesced': 0, 'batches': 0, 'written': 0, 'requeued': 0, 'failed': 0, 'blocked': 0}
+        self.thread = threading.Thread(target=self.run, name='WriteBehind', daemon=True)
+        self.thread.start()
+
+    def put(self, key, value, timeout=None):
+        with self.cond:
+            if self.closed: raise WriteBehindFullException("Write-behind buffer is closed")
+            self.stats['puts'] += 1
+            if key in self.pending:
+                self.stats['coalesced'] += 1
+                self.pending[key] = [value, 0]
+                return
+            if len(self.pending) >= self.maxPending:
+                self.stats['blocked'] += 1
+                if not self.cond.wait_for(lambda: len(self.pending) < self.maxPending or self.closed, timeout):
+                    raise WriteBehindFullException("Write-behind buffer full")
+                if self.closed: raise WriteBehindFullException("Write-behind buffer is closed")
+            self.pending[key] = [value, 0]
+            if self.oldest is None: self.oldest = time.monotonic()
+            if len(self.pending) >= self.maxBatch: self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or len(self.pending) >= self.maxBatch or
+                                   (self.pending and time.monotonic() - self.oldest >= self.flushInterval),
+                                   self.flushInterval)
+                if not self.pending:
+                    if self.closed: return
+                    continue
+                keys = list(self.pending)[:self.maxBatch]
+                batch = {k: self.pending.pop(k) for k in keys}
+                self.oldest = time.monotonic() if self.pending else None
+                self.writing += 1
+                # Room has been made for blocked put()s
+                self.cond.notify_all()
+            self.writeOut(batch)
+
+    def writeOut(self, batch):
+        try:
+            statuses = self.writeBatch({k: v[0] for k, v in batch.items()})
+        except Exception:
+            statuses = {}
+        failed = []
+        with self.cond:
+            self.stats['batches'] += 1
+            for k, (value, attempts) in batch.items():
+                status = statuses.get(k, UNKNOWN)
+                if status == CONFIRMED:
+                    self.stats['written'] += 1
+                elif k in self.pending:
+                    # A newer value is already waiting, it replaces this one
+                    pass
+                elif attempts + 1 < self.maxAttempts:
+                    self.stats['requeued'] += 1
+                    self.pending[k] = [value, attempts + 1]
+                    if self.oldest is None: self.oldest = time.monotonic()
+                else:
+                    self.stats['failed'] += 1
+                    failed.append((k, value, status))
+            self.writing -= 1
+            self.cond.notify_all()
+        if self.onFailure:
+            for k, value, status in failed: self.onFailure(k, value, status)
+
+    # Blocks until everything put so far has been written (or given up on)
+    def flush(self, timeout=None):
+        with self.cond:
+            self.oldest = 0 if self.pending else None
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def close(self, timeout=None):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def getStats(self):
+        with self.cond:
+            return dict(self.stats, pending=len(self.pending))